@@ -5,4 +5,4 @@ mkdir -p $OUTDIR
 virtualenv $OUTDIR
 cd $OUTDIR
 source bin/activate
-pip install pydot coverage
+pip install coverage
@@ -0,0 +1,136 @@
+#!/usr/bin/env python2.7
+import cPickle as pickle
+import gc
+import hashlib
+import os
+import tempfile
+import zlib
+from   source import SourceFile
+
+# modules whose code decides what is stored, a change to any of them
+# gives the compiler a new version
+compiler_modules = ("lexer", "parse", "passes", "source", "symbol_table",
+                    "syntax_tree", "tac", "visitor", "cache", "interface")
+
+_version = None
+def compiler_version():
+    """ return a hash of the source of the compiler modules, worked out
+        once in each process.
+    """
+    global _version
+    if _version is None:
+        digest = hashlib.sha1()
+        directory = os.path.dirname(os.path.realpath(__file__))
+        for name in compiler_modules:
+            with open(os.path.join(directory, name + ".py"), "rb") as f:
+                digest.update(f.read())
+        _version = digest.hexdigest()
+    return _version
+
+def default_directory():
+    return os.environ.get("PYCOMPILER_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "pycompiler"))
+
+class CompileCache(object):
+    """ CompileCache keeps the checked Program and its TAC for each source
+        on disk, so an unchanged source is not compiled again.
+
+        Entries are keyed by a hash of the source text and the compiler
+        version, and hold the two pickled together and compressed, which
+        loads several times faster than compiling. The source itself is
+        not stored, the SourceFile given to load() is put back on the
+        Program. A missing or unreadable entry is a miss, a failed store
+        leaves no entry behind.
+    """
+    magic = "PYCC1\n"
+
+    def __init__(self, directory = None, version = None):
+        self.directory = directory or default_directory()
+        self.version   = version or compiler_version()
+
+    def key(self, source):
+        """ return the key of a source string or SourceFile """
+        digest = hashlib.sha1(self.version)
+        if isinstance(source, SourceFile) and source.text is None:
+            with open(source.path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), ""):
+                    digest.update(chunk)
+        else:
+            digest.update(source.text if isinstance(source, SourceFile) else source)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def load(self, source):
+        """ return the (program, tac) stored for source, or None """
+        entry = self.read(self.key(source))
+        if entry is None:
+            return None
+        program, code = entry
+        if isinstance(source, SourceFile):
+            program.source = source
+        return program, code
+
+    def store(self, source, program, code):
+        """ store the program and tac compiled from source, returning
+            whether it could be.
+        """
+        saved = program.source
+        program.source = None
+        try:
+            return self.write(self.key(source), (program, code))
+        finally:
+            program.source = saved
+
+    def read(self, key):
+        """ return the value stored under key, or None """
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        if not data.startswith(self.magic):
+            return None
+        # nothing loaded can be garbage yet, see parse_program_parallel()
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.loads(zlib.decompress(data[len(self.magic):]))
+        except Exception:
+            return None
+        finally:
+            if enabled:
+                gc.enable()
+
+    def write(self, key, value):
+        """ store value under key, returning whether it could be """
+        path      = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            data = pickle.dumps(value, 2)
+        except (pickle.PicklingError, RuntimeError, TypeError):
+            # RuntimeError is raised for trees too deep to pickle
+            return False
+        data = zlib.compress(data, 1)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError:
+            # another process may have made it in the meantime
+            if not os.path.isdir(directory):
+                return False
+        # written aside and renamed so readers never see part of it
+        try:
+            fd, temp = tempfile.mkstemp(dir = directory)
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.magic)
+                f.write(data)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            os.remove(temp)
+            return False
+        return True
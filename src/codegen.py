@@ -10,28 +10,28 @@ class CodeGenState(object):
         self.strings = []
 
         # This will store the offsets for the
-        # All of the frames
-        self.decls        = [{}]
+        # All of the frames, indexed by the slot of each variable
+        self.offsets      = [[]]
         self.param_offset = [0]
         self.arg_offset   = [0]
         self.label_count  = 0
 
-    def new_frame(self):
-        self.decls.append({})
+    def new_frame(self, size):
+        self.offsets.append([None] * size)
         self.param_offset.append(0)
         self.arg_offset.append(0)
 
     def delete_frame(self):
-        self.decls.pop()
+        self.offsets.pop()
         self.param_offset.pop()
         self.arg_offset.pop()
 
     def add_decl(self, decl):
-        self.decls[-1][decl.name] = -self.param_offset[-1] - 4
+        self.offsets[-1][decl.name.slot[1]] = -self.param_offset[-1] - 4
         self.param_offset[-1] += self.sizeof(decl.typename)
 
     def add_arg(self, arg):
-        self.decls[-1][arg.identifier] = self.arg_offset[-1] + 8
+        self.offsets[-1][arg.identifier.slot[1]] = self.arg_offset[-1] + 8
         self.arg_offset[-1] += self.sizeof(arg.type)
 
     def sizeof(self, type):
@@ -46,7 +46,8 @@ class CodeGenState(object):
     def load(self, register, var):
         if isinstance(var, (ast.Literal, str)):
             if isinstance(var, ast.String):
-                self.outl("mov {}, strconst_{}", register, var.count)
+                # each string is given a label of its own
+                self.outl("mov {}, strconst_{}", register, len(self.strings))
                 self.strings.append(var)
             else:
                 self.outl("mov {}, {}", register, var)
@@ -64,7 +65,7 @@ class CodeGenState(object):
             self.outl("mov dword [ebp + {}], {}", offset0, val)
 
     def get_offset(self, identifier):
-        return self.decls[-1][identifier]
+        return self.offsets[-1][identifier.slot[1]]
 
     def push(self, register):
         self.pos += 4
@@ -100,7 +101,7 @@ class CodeGenState(object):
         
 
 def gen_StartFunc(x, state):
-    state.new_frame()
+    state.new_frame(len(x.frame))
     state.out("{}:", x.identifier)
     state.set_base_pointer()
 
@@ -264,8 +265,8 @@ def gen_asm(tac):
 
     state.outl('%include "stdlib/stdlib.asm"')
     state.out("section .data")
-    for x in state.strings:
-        state.out("strconst_{}:", x.count)
+    for index, x in enumerate(state.strings):
+        state.out("strconst_{}:", index)
         state.out("db {}, 0", str(x))
 
     return "\n".join(state.output)
@@ -2,36 +2,139 @@
 import os
 import argparse
 import syntax_tree as ast
+import codegen
+from   cache import CompileCache, default_directory
+from   graph import render
 from   parse import *
+from   symbol_table import builtin_table
 from   os.path import join as pjoin
 import tac
 
-def main(*args, **kwargs):
-    default_file = "single_function.x"
-    default_file = "simple_0.x"
-    filepath = os.path.dirname(os.path.realpath(__file__))
-    argument_parser = argparse.ArgumentParser()
-    argument_parser.add_argument("--input", "-i", default = pjoin(filepath, "../tests/lang/" + default_file))
-    args = argument_parser.parse_args()
+class Compiler(object):
+    """ Compiler compiles sources to assembly. Each compilation makes all
+        it changes afresh, the Compiler itself only holds what they share
+        without changing, the builtin functions and an optional
+        CompileCache, so one Compiler may run any number of compilations
+        at once from different threads.
+    """
+    def __init__(self, cache = None, jobs = 1):
+        self.builtins = builtin_table(cache)
+        self.cache    = cache
+        self.jobs     = jobs
 
-    data = open(args.input).read()
-    try:
-        program = parse(data)
-    except ParseError as e:
-        print(e)
-    program.make_tables()
+    def check(self, program):
+        """ build the symbol tables of program and check its types """
+        program.sema(builtins = self.builtins)
+        return program
+
+    def lower(self, program):
+        """ return the TAC of a checked program as a TacArray """
+        return program.make_tac(tac.TacState(tac.TacArray()))
+
+    def compile_tac(self, source):
+        """ parse, check and lower source, a string or SourceFile, returning
+            the program and its TAC. A syntax error raises a ParseError.
+        """
+        if self.cache is not None:
+            entry = self.cache.load(source)
+            if entry is not None:
+                return entry
+        program = self.check(parse(source, jobs = self.jobs))
+        code    = self.lower(program)
+        if self.cache is not None:
+            self.cache.store(source, program, code)
+        return program, code
+
+    def compile(self, source):
+        """ return the assembly of source """
+        return codegen.gen_asm(self.compile_tac(source)[1])
+
+def compile_program(data, args, compiler = None):
+    """ parse, check and lower data, returning the program and its TAC or
+        (None, None) if it has syntax errors.
+    """
+    compiler = compiler or Compiler()
+    hook = None
+    if args.profile:
+        hook = ParseProfiler()
+    elif args.trace:
+        hook = TraceHook()
+    errors = []
+    program = parse(data, window = args.stream, packrat = args.packrat, hook = hook,
+                    jobs = args.jobs, errors = errors)
+    if args.profile:
+        print(hook.report())
+    if errors:
+        for e in errors:
+            print(e.highlight(2, 2))
+        print("{} syntax error(s)".format(len(errors)))
+        return None, None
+    source = program.source or SourceFile(path = args.input)
     try:
-        program.sema()
+        compiler.check(program)
     except ast.SemaError as e:
         print(e)
-        print(e.ast.end_token.highlight(5, 5))
+        print(e.ast.highlight(source, 5, 5))
         raise
     except KeyError as e:
         print(e)
-        #print(e.ast.start_token.highlight(5, 5))
-        print(e.ast.end_token.highlight(5, 5))
+        print(e.ast.highlight(source, 5, 5))
         raise
-    t = program.make_tac(tac.TacState())
+    return program, compiler.lower(program)
+
+def main(*args, **kwargs):
+    default_file = "single_function.x"
+    default_file = "simple_0.x"
+    filepath = os.path.dirname(os.path.realpath(__file__))
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--input", "-i", default = pjoin(filepath, "../tests/lang/" + default_file))
+    argument_parser.add_argument("--stream", type = int, default = 0, metavar = "TOKENS",
+                                 help = "read the input in chunks and parse it "
+                                        "through a window of this many tokens")
+    argument_parser.add_argument("--packrat", action = "store_true",
+                                 help = "memoise parse results to avoid re-parsing")
+    argument_parser.add_argument("--jobs", "-j", type = int, default = 1,
+                                 help = "lex and parse large inputs in this many processes")
+    argument_parser.add_argument("--trace", action = "store_true",
+                                 help = "print each parser rule as it is tried")
+    argument_parser.add_argument("--profile", action = "store_true",
+                                 help = "print the calls, backtracks and time of each parser rule")
+    argument_parser.add_argument("--graph", default = "out.dot", metavar = "FILE",
+                                 help = "write the syntax tree to FILE in the DOT language, "
+                                        "an empty name writes none")
+    argument_parser.add_argument("--graph-depth", type = int, metavar = "DEPTH",
+                                 help = "leave nodes deeper than DEPTH out of the graph")
+    argument_parser.add_argument("--graph-per-function", action = "store_true",
+                                 help = "write a graph for each function, named FILE.name")
+    argument_parser.add_argument("--render", metavar = "FORMAT",
+                                 help = "draw the graphs with graphviz in FORMAT, e.g. png")
+    argument_parser.add_argument("--cache-dir", metavar = "DIR",
+                                 help = "keep compiled programs in DIR (default {})".format(
+                                        default_directory()))
+    argument_parser.add_argument("--no-cache", action = "store_true",
+                                 help = "compile without reading or writing the cache")
+    args = argument_parser.parse_args()
+
+    if args.stream:
+        data = tokenise_file(open(args.input))
+    else:
+        data = SourceFile.from_path(args.input)
+    source = data
+    cache  = None if args.no_cache else CompileCache(args.cache_dir)
+    # a streamed, traced or profiled compilation is always run afresh, it
+    # only uses the cache for the stdlib snapshot
+    reuse  = cache is not None and not (args.stream or args.trace or args.profile)
+    entry  = cache.load(source) if reuse else None
+    if entry is not None:
+        program, t = entry
+    else:
+        if args.jobs > 1 and not args.stream:
+            data = tokenise_parallel(data, args.jobs)
+        program, t = compile_program(data, args, Compiler(cache))
+        if program is None:
+            return
+        if reuse:
+            cache.store(source, program, t)
     for x in t:
         if isinstance(x, (tac.Label, tac.StartFunc, tac.EndFunc)):
             print(x)
@@ -39,7 +142,16 @@ def main(*args, **kwargs):
             print("\t{}".format(x))
         if isinstance(x, tac.EndFunc):
             print("")
-    graph = program.output_graph("out.png")
+    if args.graph:
+        if args.graph_per_function:
+            root, ext = os.path.splitext(args.graph)
+            names = program.output_function_graphs(root + ".{}" + ext, args.graph_depth)
+        else:
+            program.output_graph(args.graph, args.graph_depth)
+            names = [args.graph]
+        if args.render:
+            for name in names:
+                render(name, os.path.splitext(name)[0] + "." + args.render)
 
 if __name__ == "__main__":
     main()
@@ -1,42 +1,89 @@
 #!/usr/bin/env python2.7
-import pydot
-
-class Graph(object):
-    def __init__(self):
-        self.graph= pydot.Dot(graph_type = "digraph")
-        self.nodes = []
-        self.edges = []
-
-    def add_node(self, name, shape = "box"):
-        node = pydot.Node(len(self.nodes),
-                          label = '"{}"'.format(name),
-                          shape=shape)
-        self.nodes.append(node)
-        self.graph.add_node(self.nodes[-1])
-        return len(self.nodes) - 1
-
-    def add_edge(self, index0, index1, label = ""):
-        edge = pydot.Edge(self.nodes[index0],
-                          self.nodes[index1],
-                          label = '"{}"'.format(label))
-        self.edges.append(edge)
-        self.graph.add_edge(self.edges[-1])
-        return len(self.edges) - 1
-
-    def output(self, filename):
-        self.graph.write_png(filename)
+import os
+import subprocess
+
+def quote(text):
+    """ return text as a DOT string """
+    text = str(text).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return '"{}"'.format(text)
+
+class DotWriter(object):
+    """ DotWriter writes a graph in the DOT language to a file as its nodes
+        and edges are added, so nothing of the graph is kept in memory.
+
+        Nodes are numbered in the order they are added, an edge may name a
+        node by a negative number counting back from the last one added.
+        depth and max_depth are left for the code walking a tree into the
+        graph, see syntax_tree.child_graph().
+    """
+    def __init__(self, out, max_depth = None):
+        self.out       = out
+        self.count     = 0
+        self.depth     = 0
+        self.max_depth = max_depth
+        out.write("digraph {\n")
+
+    def add_node(self, label, shape = "box"):
+        index = self.count
+        self.count += 1
+        if shape:
+            self.out.write("{} [label={}, shape={}];\n".format(index, quote(label), shape))
+        else:
+            self.out.write("{} [label={}];\n".format(index, quote(label)))
+        return index
+
+    def add_edge(self, node0, node1, label = ""):
+        if node0 < 0:
+            node0 += self.count
+        if node1 < 0:
+            node1 += self.count
+        if label:
+            self.out.write("{} -> {} [label={}];\n".format(node0, node1, quote(label)))
+        else:
+            self.out.write("{} -> {};\n".format(node0, node1))
+
+    def close(self):
+        self.out.write("}\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Graph(DotWriter):
+    """ DotWriter to a file of its own """
+    def __init__(self, filename, max_depth = None):
+        self.filename = filename
+        super(Graph, self).__init__(open(filename, "w"), max_depth)
+
+    def close(self):
+        super(Graph, self).close()
+        self.out.close()
+
+    def render(self, output, format = None):
+        render(self.filename, output, format)
+
+def render(filename, output, format = None):
+    """ draw the DOT file filename to output with graphviz, in the format
+        named by the extension of output unless one is given.
+    """
+    if format is None:
+        format = os.path.splitext(output)[1][1:] or "png"
+    subprocess.check_call(["dot", "-T" + format, "-o", output, filename])
 
 def main():
-    g = Graph()
     some = """\
     some really long paragraph
     that keeps going on and on
     and on and on and on.
     """
 
-    g.add_node("node0")
-    g.add_node("node1")
-    g.add_edge(0, 1, "edge 1")
-    g.output("out.png")
+    with Graph("out.dot") as g:
+        g.add_node("node0")
+        g.add_node("node1")
+        g.add_edge(0, 1, "edge 1")
+    render("out.dot", "out.png")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python2.7
+import os
+import syntax_tree as ast
+from   symbol_table import SymbolTable
+
+# the interface of stdlib/stdlib.asm
+default_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                            "stdlib", "stdlib.x")
+
+def compile_interface(text):
+    """ return a root SymbolTable of the functions declared in the
+        interface text.
+    """
+    # parse imports symbol_table, which loads this module
+    from parse import parse
+    table = SymbolTable()
+    for s in parse(text).statements:
+        if isinstance(s, ast.Function):
+            table[s.name] = s
+    return table
+
+# the tables loaded in this process by their keys, or by their text if
+# compiled without a cache, they are only looked in so each is shared by
+# every compilation
+_tables = {}
+# the same tables by the path, size and time of change of the file and
+# the directory of the cache they were loaded with, so that the file is
+# not read again while it is unchanged
+_paths = {}
+
+def load_interface(path = None, cache = None):
+    """ return the table of the interface at path, the stdlib by default.
+
+        Given a CompileCache the table is compiled once and kept in it as
+        a snapshot, which later processes load in place of parsing the
+        interface. It is compiled again if the interface or the compiler
+        changes, and in each process if the snapshot cannot be kept.
+        Without one it is compiled in each process and nothing is written.
+    """
+    path  = os.path.realpath(path or default_path)
+    info  = os.stat(path)
+    stamp = (path, info.st_size, info.st_mtime,
+             None if cache is None else cache.directory)
+    table = _paths.get(stamp)
+    if table is not None:
+        return table
+    with open(path, "rb") as f:
+        text = f.read()
+    key = text if cache is None else cache.key("interface\n" + text)
+    table = _tables.get(key)
+    if table is None:
+        if cache is not None:
+            table = cache.read(key)
+        if table is None:
+            table = compile_interface(text)
+            if cache is not None:
+                cache.write(key, table)
+        _tables[key] = table
+    _paths[stamp] = table
+    return table
@@ -1,12 +1,26 @@
 #!/usr/bin/env python2.7
+import multiprocessing
+import os
 import re
+from   array  import array
+from   bisect import bisect_left
+from   source import SourceFile
 
 class Token(object):
-    def __init__(self, value, line, pos, data):
-        self.value = value
-        self.line  = line
-        self.pos   = pos
-        self.data  = data
+    __slots__ = ("kind", "value", "line", "pos", "source", "offset")
+
+    def __init__(self, value, line, pos, source, offset = -1):
+        self.kind   = self.kind_id
+        self.value  = value
+        self.line   = line
+        self.pos    = pos
+        self.source = source
+        self.offset = offset
+
+    def __reduce__(self):
+        # the constructors rewrite their arguments, so rebuild the slots
+        return rebuild_token, (type(self), self.kind, self.value, self.line,
+                               self.pos, self.source, self.offset)
 
     def get_value(self):
         return self.value
@@ -15,6 +29,10 @@ class Token(object):
         """ return the position in the line of the token"""
         return self.pos
 
+    def get_end(self):
+        """ return the offset of the character after the token """
+        return self.offset + len(self.value)
+
     def get_line(self):
         """ return the line the token is on """
         return self.line
@@ -32,67 +50,83 @@ class Token(object):
 
     def highlight(self, context_above = 0, context_below = 0):
         assert context_above >= 0 and context_below >= 0
-        out = ""
         lineno = self.get_line()
-        lines = self.data.split("\n")
-        pos  = self.get_pos()
-        for line in lines[max(0, lineno - context_above):lineno]:
-            out += line + "\n"
-        out += lines[lineno] + "\n"
-        out += " " * pos + "^" + "~" * (len(self.value) - 1) + "\n"
-        for line in lines[lineno + 1:lineno + context_below + 1]:
-            out += line + "\n"
-        return out
+        pos    = self.get_pos()
+        if self.source is None:
+            # streamed tokens from an unnamed file have no source to show
+            return "line {}, pos {}: {}\n".format(lineno + 1, pos, self.value)
+        return self.source.highlight(lineno, pos, len(self.value),
+                                     context_above, context_below)
 
-class Keyword(Token): pass
-class Number(Token): pass
-class Integer(Number): pass
-class Float(Number): pass
-class LParen(Token): pass
-class RParen(Token): pass
-class LBrace(Token): pass
-class RBrace(Token): pass
-class LCurly(Token): pass
-class RCurly(Token): pass
-class Whitespace(Token): pass
-class Comment(Token): pass
-class LArrow(Token): pass
-class RArrow(Token): pass
-class Comma(Token): pass
-class Colon(Token): pass
-class Semicolon(Token): pass
-class Period(Token): pass
+def rebuild_token(cls, kind, value, line, pos, source, offset):
+    token = object.__new__(cls)
+    token.kind   = kind
+    token.value  = value
+    token.line   = line
+    token.pos    = pos
+    token.source = source
+    token.offset = offset
+    return token
+
+class Keyword(Token):
+    __slots__ = ()
+    def __init__(self, value, line, pos, source, offset = -1):
+        super(Keyword, self).__init__(value, line, pos, source, offset)
+        self.kind = keyword_kinds.get(value, self.kind_id)
+
+class Number(Token): __slots__ = ()
+class Integer(Number): __slots__ = ()
+class Float(Number): __slots__ = ()
+class LParen(Token): __slots__ = ()
+class RParen(Token): __slots__ = ()
+class LBrace(Token): __slots__ = ()
+class RBrace(Token): __slots__ = ()
+class LCurly(Token): __slots__ = ()
+class RCurly(Token): __slots__ = ()
+class Whitespace(Token): __slots__ = ()
+class Comment(Token): __slots__ = ()
+class LArrow(Token): __slots__ = ()
+class RArrow(Token): __slots__ = ()
+class Comma(Token): __slots__ = ()
+class Colon(Token): __slots__ = ()
+class Semicolon(Token): __slots__ = ()
+class Period(Token): __slots__ = ()
 class Newline(Whitespace):
-    def __init__(self, value, line, pos, data):
-        super(Whitespace, self).__init__("\n", line, pos, data)
+    __slots__ = ()
+    def __init__(self, value, line, pos, source, offset = -1):
+        super(Whitespace, self).__init__("\n", line, pos, source, offset)
 
 class String(Token):
-    def __init__(self, value, line, pos, data):
-        super(String, self).__init__(value[1:-1], line, pos, data)
+    __slots__ = ()
+    def __init__(self, value, line, pos, source, offset = -1):
+        super(String, self).__init__(value[1:-1], line, pos, source, offset)
+
+    def get_end(self):
+        return self.offset + len(self.value) + 2
 
 #Ops
-class Op(Token): pass
-class Add(Op): pass
-class Sub(Op): pass
-class Div(Op): pass
-class Mult(Op): pass
+class Op(Token): __slots__ = ()
+class Add(Op): __slots__ = ()
+class Sub(Op): __slots__ = ()
+class Div(Op): __slots__ = ()
+class Mult(Op): __slots__ = ()
 
 #Comps
-class Comp(Token): pass
-class EQ(Comp): pass
-class LTEQ(Comp): pass
-class LT(Comp): pass
-class GT(Comp): pass
-class GTEQ(Comp): pass
-class NEQ(Comp): pass
+class Comp(Token): __slots__ = ()
+class EQ(Comp): __slots__ = ()
+class LTEQ(Comp): __slots__ = ()
+class LT(Comp): __slots__ = ()
+class GT(Comp): __slots__ = ()
+class GTEQ(Comp): __slots__ = ()
+class NEQ(Comp): __slots__ = ()
 
 #Assignes
-class AssignBase(Token): pass
-class Assign(AssignBase): pass
-class AddAssign(AssignBase): pass
-class SubAssign(AssignBase): pass
-class MultAssign(AssignBase): pass
-class DivAssign(AssignBase): pass
+class AssignBase(Token): __slots__ = ()
+class Assign(AssignBase): __slots__ = ()
+class AddAssign(AssignBase): __slots__ = ()
+class SubAssign(AssignBase): __slots__ = ()
+class MultAssign(AssignBase): __slots__ = ()
+class DivAssign(AssignBase): __slots__ = ()
 
 keyword_list = (
     "and",
@@ -110,12 +144,42 @@ keyword_list = (
 )
 
 class Identifier(Token):
-    def __new__(cls, value, line, pos, data):
+    __slots__ = ()
+    def __new__(cls, value, line, pos, source, offset = -1):
         if value in keyword_list:
-            return Keyword(value, line, pos, data)
-        out = object.__new__(cls, value, line, pos, data)
+            return Keyword(value, line, pos, source, offset)
+        out = object.__new__(cls, value, line, pos, source, offset)
         return out
 
+# Every token class, and every keyword, gets a small integer kind so the
+# parser can test tokens with a bit test instead of isinstance/value
+# comparisons. kind_bits on a class covers the class and all its subclasses.
+token_classes = (
+    Token, Keyword, Number, Integer, Float, LParen, RParen, LBrace, RBrace,
+    LCurly, RCurly, Whitespace, Comment, LArrow, RArrow, Comma, Colon,
+    Semicolon, Period, Newline, String, Op, Add, Sub, Div, Mult, Comp, EQ,
+    LTEQ, LT, GT, GTEQ, NEQ, AssignBase, Assign, AddAssign, SubAssign,
+    MultAssign, DivAssign, Identifier,
+)
+
+keyword_kinds = dict((keyword, kind) for kind, keyword in
+                     enumerate(keyword_list, len(token_classes)))
+
+kind_classes = list(token_classes) + [Keyword] * len(keyword_list)
+kind_count   = len(kind_classes)
+
+for kind, token_type in enumerate(token_classes):
+    token_type.kind_id = kind
+
+for token_type in token_classes:
+    token_type.kind_bits = 0
+    for other in token_classes:
+        if issubclass(other, token_type):
+            token_type.kind_bits |= 1 << other.kind_id
+    if issubclass(Keyword, token_type):
+        for kind in keyword_kinds.values():
+            token_type.kind_bits |= 1 << kind
+
 token_dict = (
     (re.compile(r"^//.*\n"), Comment), #Remove comment first
     (re.compile(r"^\d*[.]\d+([eE]\d+)?") , Float),
@@ -168,23 +232,396 @@ def set_line_pos(value, line, pos):
         pos += len(value)
     return line, pos
 
+def make_master_pattern(rules):
+    """ Combine an ordered rule table into a single alternation.
 
-def tokenise(data):
-    pos = 0
-    line = 0
-    string = data
-    while string:
-        for pattern, token_type in token_dict:
-            match = pattern.match(string)
-            if match:
-                value = match.group(0)
-                string = string[len(value):]
-                if token_type not in (Whitespace, Comment):
-                    yield token_type(value, line, pos, data)
-                line, pos = set_line_pos(value, line, pos)
+        Each rule becomes a named group so the winning rule can be read
+        back from match.lastgroup, alternation order keeps the
+        first-match-wins priority of the table.
+    """
+    groups = []
+    for index, (pattern, token_type) in enumerate(rules):
+        source = pattern.pattern
+        if source.startswith("^"):
+            source = source[1:]
+        groups.append("(?P<t{}>{})".format(index, source))
+    return re.compile("|".join(groups))
+
+master_pattern = make_master_pattern(token_dict)
+master_types   = dict(("t{}".format(index), token_type)
+                      for index, (_, token_type) in enumerate(token_dict))
+
+def scan(data, offset = 0, line = 0, pos = 0, end = None):
+    """ yield (token_type, value, offset, line, pos) for every token that
+        is not whitespace or a comment, starting from the given state.
+    """
+    match_at = master_pattern.match
+    types    = master_types
+    if end is None:
+        end  = len(data)
+    while offset < end:
+        match = match_at(data, offset)
+        if not match:
+            raise Exception("Lexing error:\n{}".format(data[offset:]))
+        value = match.group()
+        token_type = types[match.lastgroup]
+        if token_type not in (Whitespace, Comment):
+            yield token_type, value, offset, line, pos
+        line, pos = set_line_pos(value, line, pos)
+        offset = match.end()
+
+def scan_file(fileobj, chunk_size = 1 << 16):
+    """ scan() over a file-like object (or an mmap) read in chunks.
+
+        Only the unfinished tail of the current chunk is carried over. A
+        token is taken only once it ends before the last newline read so
+        far, no rule looks past a newline except a string literal, and a
+        string that is not closed yet does not match at all.
+    """
+    match_at = master_pattern.match
+    types    = master_types
+    buffer   = ""
+    base     = 0
+    line     = 0
+    pos      = 0
+    eof      = False
+    while not eof:
+        chunk  = fileobj.read(chunk_size)
+        eof    = not chunk
+        buffer += chunk
+        limit  = len(buffer) if eof else buffer.rfind("\n")
+        offset = 0
+        while offset < len(buffer):
+            match = match_at(buffer, offset)
+            if not match and eof:
+                raise Exception("Lexing error:\n{}".format(buffer[offset:]))
+            if not match or match.end() > limit:
                 break
+            value = match.group()
+            token_type = types[match.lastgroup]
+            if token_type not in (Whitespace, Comment):
+                yield token_type, value, base + offset, line, pos
+            line, pos = set_line_pos(value, line, pos)
+            offset = match.end()
+        buffer = buffer[offset:]
+        base  += offset
+
+def as_source(data):
+    if isinstance(data, SourceFile):
+        return data
+    return SourceFile(data)
+
+def tokenise(data):
+    source = as_source(data)
+    for token_type, value, offset, line, pos in scan(source.text):
+        yield token_type(value, line, pos, source, offset)
+
+def tokenise_file(fileobj, chunk_size = 1 << 16, path = None):
+    """ tokenise a file-like object without holding the whole source.
+
+        The tokens refer to a SourceFile that reads lines back from path
+        (by default the name of the file object) when highlighting.
+    """
+    if path is None:
+        path = getattr(fileobj, "name", None)
+    source = None
+    if isinstance(path, str) and os.path.isfile(path):
+        source = SourceFile(path = path)
+    for token_type, value, offset, line, pos in scan_file(fileobj, chunk_size):
+        yield token_type(value, line, pos, source, offset)
+
+class TokenStream(object):
+    """ Compact storage for the tokens of a source string.
+
+        Tokens are kept as parallel arrays of kind, offset, length, line
+        and position, the token objects themselves are only created when
+        indexed and take their value as a slice of the source.
+    """
+    def __init__(self, source):
+        self.source  = source
+        self.kinds   = array("B")
+        self.starts  = array("i")
+        self.lengths = array("i")
+        self.lines   = array("i")
+        self.cols    = array("i")
+        # the parser asks for the same token several times in a row as it
+        # enters nested rules, so keep the last one built.
+        self._cached = (None, None)
+
+    def append(self, kind, start, length, line, pos):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.lengths.append(length)
+        self.lines.append(line)
+        self.cols.append(pos)
+
+    def kind(self, index):
+        return self.kinds[index]
+
+    def edit(self, offset, removed, inserted):
+        """ Replace `removed` characters at `offset` in the source with
+            the text `inserted`, re-lexing only the tokens around the edit.
+
+            A comment looks ahead to the end of its line, so scanning
+            restarts from the last token before the line holding the edit.
+            It stops as soon as it reaches an old token boundary past the
+            edit, the old tokens from there on are kept with their offset,
+            line and pos shifted. return the (start, stop) range of the
+            new tokens.
+        """
+        source  = self.source.edit(offset, removed, inserted)
+        delta   = len(inserted) - removed
+        count   = len(self)
+        starts  = self.starts
+        line_start = self.source.text.rfind("\n", 0, offset) + 1
+        first   = max(0, bisect_left(starts, line_start) - 1)
+        restart = (0, 0, 0)
+        if first < count and starts[first] < line_start:
+            restart = (starts[first], self.lines[first], self.cols[first])
+
+        new  = TokenStream(source)
+        old  = bisect_left(starts, offset + removed)
+        sync = count
+        for token_type, value, start, line, pos in scan(source.text, *restart):
+            kind = token_kind(token_type, value)
+            if start >= offset + len(inserted):
+                while old < count and starts[old] + delta < start:
+                    old += 1
+                if (old < count and starts[old] + delta == start and
+                    self.kinds[old] == kind and self.lengths[old] == len(value)):
+                    sync = old
+                    break
+            new.append(kind, start, len(value), line, pos)
+
+        if sync < count:
+            line_delta = line - self.lines[sync]
+            pos_delta  = pos - self.cols[sync]
+            sync_line  = self.lines[sync]
+            index = sync
+            while pos_delta and index < count and self.lines[index] == sync_line:
+                self.cols[index] += pos_delta
+                index += 1
+            if delta:
+                starts[sync:] = array("i", [x + delta for x in starts[sync:]])
+            if line_delta:
+                self.lines[sync:] = array("i", [x + line_delta
+                                                for x in self.lines[sync:]])
+
+        self.kinds[first:sync]   = new.kinds
+        self.starts[first:sync]  = new.starts
+        self.lengths[first:sync] = new.lengths
+        self.lines[first:sync]   = new.lines
+        self.cols[first:sync]    = new.cols
+        self.source  = source
+        self._cached = (None, None)
+        return first, first + len(new)
+
+    def span(self, first, last):
+        """ return the offsets of the start of token first and of the end
+            of token last. A run of newlines ends after the first of them,
+            as the Newline token does.
+        """
+        if self.kinds[last] == Newline.kind_id:
+            return self.starts[first], self.starts[last] + 1
+        return self.starts[first], self.starts[last] + self.lengths[last]
+
+    def value(self, index):
+        """ return the raw source text of a token """
+        start = self.starts[index]
+        return self.source.text[start:start + self.lengths[index]]
+
+    def __getitem__(self, index):
+        cached_index, token = self._cached
+        if index == cached_index:
+            return token
+        token_type = kind_classes[self.kinds[index]]
+        token = token_type(self.value(index), self.lines[index],
+                           self.cols[index], self.source, self.starts[index])
+        self._cached = (index, token)
+        return token
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+class TokenList(list):
+    """ Adapts a plain sequence of tokens to the TokenStream interface """
+    def kind(self, index):
+        return self[index].kind
+
+    def span(self, first, last):
+        return self[first].offset, self[last].get_end()
+
+class TokenWindowError(RuntimeError):
+    pass
+
+class TokenWindow(object):
+    """ Ring buffer over a token iterator, exposing the TokenStream
+        interface for the last `size` tokens read.
+
+        Tokens are pulled from the iterator as they are indexed, indexing
+        a token that has already dropped out of the buffer raises
+        TokenWindowError. The start offset of every token read is kept,
+        so spans may begin outside the buffer.
+    """
+    def __init__(self, tokens, size = 4096):
+        self.tokens = iter(tokens)
+        self.size   = size
+        self.buffer = [None] * size
+        self.count  = 0
+        self.starts = array("i")
+
+    def fill(self, index):
+        while self.count <= index:
+            try:
+                token = next(self.tokens)
+            except StopIteration:
+                raise IndexError(index)
+            self.buffer[self.count % self.size] = token
+            self.starts.append(token.offset)
+            self.count += 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            raise IndexError(index)
+        self.fill(index)
+        if index < self.count - self.size:
+            raise TokenWindowError(
+                "token {} is outside the window of {} tokens".format(index, self.size))
+        return self.buffer[index % self.size]
+
+    def kind(self, index):
+        return self[index].kind
+
+    def span(self, first, last):
+        return self.starts[first], self[last].get_end()
+
+def token_kind(token_type, value):
+    if token_type is Identifier:
+        return keyword_kinds.get(value, Identifier.kind_id)
+    return token_type.kind_id
+
+def tokenise_stream(data):
+    stream = TokenStream(as_source(data))
+    append = stream.append
+    for token_type, value, offset, line, pos in scan(stream.source.text):
+        append(token_kind(token_type, value), offset, len(value), line, pos)
+    return stream
+
+# Sources shorter than this are not worth starting worker processes for.
+parallel_threshold = 1 << 20
+
+# String literals and comments, the only places a newline is not a point at
+# which the lexer can be restarted.
+_literal_pattern = re.compile(r'"[^"]*"|//[^\n]*')
+_newlines        = re.compile(r"\n+")
+
+def split_points(text, parts):
+    """ return up to parts - 1 offsets that split text into roughly equal
+        chunks. Each offset follows a run of newlines that is not inside a
+        string literal, so lexing each chunk separately gives the same
+        tokens as lexing the whole text.
+    """
+    literals = _literal_pattern.finditer(text)
+    literal  = next(literals, None)
+    points   = []
+    for part in range(1, parts):
+        index = len(text) * part // parts
+        if points:
+            index = max(index, points[-1])
+        while True:
+            newline = text.find("\n", index)
+            if newline == -1:
+                return points
+            while literal and literal.end() <= newline:
+                literal = next(literals, None)
+            if literal and literal.start() <= newline:
+                index = literal.end()
+                continue
+            point = _newlines.match(text, newline).end()
+            if point < len(text) and (not points or point > points[-1]):
+                points.append(point)
+            break
+    return points
+
+_worker_text = None
+def _init_worker(text):
+    global _worker_text
+    _worker_text = text
+
+def _lex_chunk(chunk):
+    start, end, line = chunk
+    stream = TokenStream(None)
+    append = stream.append
+    for token_type, value, offset, line, pos in scan(_worker_text, start, line, 0, end):
+        append(token_kind(token_type, value), offset, len(value), line, pos)
+    return stream.kinds, stream.starts, stream.lengths, stream.lines, stream.cols
+
+def tokenise_parallel(data, processes = None, threshold = None):
+    """ tokenise_stream() split across a pool of worker processes.
+
+        Sources shorter than threshold (parallel_threshold by default) are
+        lexed in this process.
+    """
+    source = as_source(data)
+    text   = source.text
+    if threshold is None:
+        threshold = parallel_threshold
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if len(text) < threshold or processes < 2:
+        return tokenise_stream(source)
+
+    bounds = [0] + split_points(text, processes) + [len(text)]
+    chunks = []
+    line   = 0
+    for start, end in zip(bounds, bounds[1:]):
+        chunks.append((start, end, line))
+        line += text.count("\n", start, end)
+
+    pool = multiprocessing.Pool(len(chunks), _init_worker, (text,))
+    try:
+        results = pool.map(_lex_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    stream = TokenStream(source)
+    for kinds, starts, lengths, lines, cols in results:
+        stream.kinds.extend(kinds)
+        stream.starts.extend(starts)
+        stream.lengths.extend(lengths)
+        stream.lines.extend(lines)
+        stream.cols.extend(cols)
+    return stream
+
+_mask_cache = {}
+def kind_mask(*tests):
+    """ return a bit mask of the token kinds matched by any of the tests,
+        a test is either a token class or the spelling of a fixed token
+        such as "(" or "while".
+    """
+    try:
+        return _mask_cache[tests]
+    except KeyError:
+        pass
+    mask = 0
+    for test in tests:
+        if isinstance(test, type):
+            mask |= test.kind_bits
         else:
-            raise Exception("Lexing error:\n{}".format(string))
+            mask |= 1 << literal_kind(test)
+    _mask_cache[tests] = mask
+    return mask
+
+def literal_kind(value):
+    tokens = [x for x in tokenise(value)]
+    if len(tokens) != 1 or isinstance(tokens[0], (Identifier, Number, String)):
+        raise ValueError("{} is not a fixed token".format(repr(value)))
+    return tokens[0].kind
 
 if __name__ == "__main__": # pragma: no cover
     import argparse
@@ -1,15 +1,40 @@
 #!/usr/bin/env python2.7
+import cPickle as pickle
 import functools
+import gc
+import multiprocessing
+import re
 import syntax_tree as ast
 import sys
-from   lexer import *
+import timeit
+from   bisect    import bisect_left
+from   lexer     import *
 
 class Parser(object):
-    def __init__(self, tokens):
-        if type(tokens) == str:
-            tokens = [x for x in tokenise(tokens)]
+    def __init__(self, tokens, window = None, packrat = False, hook = None,
+                 errors = None):
+        """ tokens may be a source string, a token stream or any iterable
+            of tokens. If window is given the tokens are read through a
+            ring buffer of that many tokens instead of being held in full.
+            If packrat is set the result of every rule at every position
+            is memoised, see commit().
+            hook is a ParseHook told about every rule entered.
+            If errors is a list the parser recovers from syntax errors,
+            adding each ParseError to it instead of raising it.
+        """
+        if isinstance(tokens, (str, SourceFile)):
+            tokens = tokenise_stream(tokens)
+        elif window:
+            tokens = TokenWindow(tokens, window)
+        elif not hasattr(tokens, "kind"):
+            tokens = TokenList(tokens)
         self.tokens = tokens
         self.pos    = -1
+        self.memo   = {} if packrat else None
+        self.hook   = hook
+        self.errors = errors
+        # rules take the plain path unless told otherwise, see parsefunc
+        self.instrumented = packrat or hook is not None
 
     def next(self):
         try:
@@ -22,7 +47,8 @@ class Parser(object):
     def peek(self, *test):
         try:
             if len(test):
-                return any( self.tokens[self.pos + 1] == x for x in test)
+                kind = self.tokens.kind(self.pos + 1)
+                return bool(kind_mask(*test) >> kind & 1)
             else:
                 return self.tokens[self.pos + 1]
         except IndexError:
@@ -35,61 +61,367 @@ class Parser(object):
             raise InvalidParse()
 
     def expect(self, test, message = ""):
-        if self.cur() != test:
+        try:
+            kind = self.tokens.kind(self.pos)
+        except IndexError:
+            raise InvalidParse()
+        if not kind_mask(test) >> kind & 1:
             raise InvalidParse(message)
         return self.cur()
 
     def accept(self, test, message = ""):
-        self.next()
+        self.pos += 1
         return self.expect(test, message)
 
     def done(self):
-        return self.pos + 1 == len(self.tokens)
+        try:
+            self.tokens.kind(self.pos + 1)
+        except IndexError:
+            return True
+        return False
 
     def consume(self, test):
         while self.peek(test):
-            self.next()
+            self.pos += 1
+
+    def lookahead(self, masks, start = 1):
+        """ return whether the tokens from pos + start on match the given
+            kind masks, one mask per token.
+        """
+        index = self.pos + start
+        for mask in masks:
+            try:
+                kind = self.tokens.kind(index)
+            except IndexError:
+                return False
+            if not mask >> kind & 1:
+                return False
+            index += 1
+        return True
+
+    def commit(self):
+        """ mark the current position as one the parser will not backtrack
+            behind, memoised results for earlier positions are dropped.
+        """
+        if self.memo:
+            pos = self.pos
+            self.memo = dict((key, value) for key, value in self.memo.items()
+                             if key[1] >= pos)
 
     def __getitem__(self, index):
         return self.tokens[index]
 
-indent  = 0
-verbose = 0
+    def span(self, pos, end):
+        """ return the source offsets covered by the tokens after pos up to
+            and including end, a rule that started at pos and finished at
+            end covers those.
+        """
+        if end > pos:
+            return self.tokens.span(pos + 1, end)
+        if pos >= 0:
+            offset = self.tokens.span(pos, pos)[1]
+            return offset, offset
+        return 0, 0
+
 def parsefunc(func):
+    """ make a rule of func, which sets the span of the node it returns
+        and puts the parser back where it started if it fails. A parser
+        with neither a hook nor packrat takes the plain path, which does
+        nothing else.
+    """
     @functools.wraps(func)
     def wrap(parser):
-        global indent
+        if parser.instrumented:
+            return run_instrumented(parser, func)
         pos = parser.pos
-        start_token = parser[pos] if pos >= 0 else None
-        if verbose:
-            print("\t" * indent + "enter: " + func.__name__)
-        indent += 1
         try:
             retval = func(parser)
-            indent -= 1
-            if verbose:
-                print("\t" * indent + "OK   : " + func.__name__)
-            retval.start_token = start_token
-            pos = parser.pos
-            retval.end_token   = parser[pos] if pos >= 1 else None
-            return retval
         except InvalidParse as e:
             if e.function == None:
                 e.function = func
             parser.pos = pos
-            indent -= 1
-            if verbose:
-                print("\t" * indent + "fail : " + func.__name__)
             raise
+        retval.start, retval.end = parser.span(pos, parser.pos)
+        return retval
     return wrap
 
+def run_instrumented(parser, func):
+    """ run a parsefunc rule telling the hook about it and memoising its
+        result, either of which may be None.
+    """
+    pos  = parser.pos
+    hook = parser.hook
+    memo = parser.memo
+    if hook is not None:
+        hook.enter(func, pos)
+    if memo is not None:
+        entry = memo.get((func, pos))
+        if isinstance(entry, InvalidParse):
+            if hook is not None:
+                hook.fail(func, pos)
+            raise entry
+        if entry is not None:
+            retval, parser.pos = entry
+            if hook is not None:
+                hook.exit(func, pos, parser.pos)
+            return retval
+    try:
+        retval = func(parser)
+    except InvalidParse as e:
+        if e.function == None:
+            e.function = func
+        parser.pos = pos
+        if memo is not None:
+            memo[(func, pos)] = e
+        if hook is not None:
+            hook.fail(func, pos)
+        raise
+    except ParseError:
+        if hook is not None:
+            hook.fail(func, pos)
+        raise
+    end = parser.pos
+    retval.start, retval.end = parser.span(pos, end)
+    if memo is not None:
+        memo[(func, pos)] = (retval, end)
+    if hook is not None:
+        hook.exit(func, pos, end)
+    return retval
+
+def blockfunc(steps):
+    """ make a rule out of a generator that may hold nested blocks.
+        The generator yields the rules whose results it needs and gets
+        them sent back, its last yield is the finished node. Such rules
+        are run by run_blocks from an explicit stack, so nesting does not
+        use up Python frames.
+    """
+    @functools.wraps(steps)
+    def wrap(parser):
+        return run_blocks(parser, wrap)
+    wrap.steps = steps
+    return wrap
+
+def enter_block(parser, func):
+    pos = parser.pos
+    if parser.hook is not None:
+        parser.hook.enter(func, pos)
+    return func, pos, func.steps(parser)
+
+def run_blocks(parser, func):
+    """ run a blockfunc rule, keeping the same spans, hook calls and
+        failure handling as parsefunc. When recovering from errors a
+        ParseError is passed to the innermost statement list.
+    """
+    stack  = [enter_block(parser, func)]
+    result = None
+    error  = None
+    while True:
+        func, pos, steps = stack[-1]
+        try:
+            if error is not None:
+                value = steps.throw(error)
+            else:
+                value = steps.send(result)
+        except InvalidParse as e:
+            if e.function == None:
+                e.function = func
+            parser.pos = pos
+            if parser.hook is not None:
+                parser.hook.fail(func, pos)
+            stack.pop()
+            if not stack:
+                raise
+            result, error = None, e
+            continue
+        except ParseError as e:
+            if parser.errors is None:
+                raise
+            while stack and stack[-1][0] is not parse_statement_list:
+                if parser.hook is not None:
+                    parser.hook.fail(stack[-1][0], stack[-1][1])
+                stack.pop()
+            if not stack:
+                raise
+            result, error = None, e
+            continue
+        result, error = None, None
+        if isinstance(value, ast.AST):
+            end = parser.pos
+            value.start, value.end = parser.span(pos, end)
+            if parser.hook is not None:
+                parser.hook.exit(func, pos, end)
+            stack.pop()
+            if not stack:
+                return value
+            result = value
+        elif hasattr(value, "steps"):
+            stack.append(enter_block(parser, value))
+        else:
+            try:
+                result = value(parser)
+            except InvalidParse as e:
+                error = e
+
+class ParseHook(object):
+    """ ParseHook is told when the parser enters a rule, and when the
+        rule returns or fails. pos is the token position the rule started
+        at and end the position it finished at. A rule a ParseError passes
+        through counts as failed.
+    """
+    def enter(self, func, pos):
+        pass
+
+    def exit(self, func, pos, end):
+        pass
+
+    def fail(self, func, pos):
+        pass
+
+class TraceHook(ParseHook):
+    """ print every rule entered, returned and failed, indented by depth,
+        to out or to sys.stdout as it is when each line is written.
+    """
+    def __init__(self, out = None):
+        self.out   = out
+        self.depth = 0
+
+    def write(self, event, func):
+        out = self.out or sys.stdout
+        out.write("\t" * self.depth + event + ": " + func.__name__ + "\n")
+
+    def enter(self, func, pos):
+        self.write("enter", func)
+        self.depth += 1
+
+    def exit(self, func, pos, end):
+        self.depth -= 1
+        self.write("OK   ", func)
+
+    def fail(self, func, pos):
+        self.depth -= 1
+        self.write("fail ", func)
+
+class ParseProfiler(ParseHook):
+    """ count the calls and backtracks of each rule along with the time
+        spent in it. Time is cumulative, it includes the rules called from
+        a rule and counts a recursive rule once.
+    """
+    def __init__(self, clock = timeit.default_timer):
+        self.clock      = clock
+        self.calls      = {}
+        self.backtracks = {}
+        self.time       = {}
+        self.active     = {}
+        self.stack      = []
+
+    def enter(self, func, pos):
+        name = func.__name__
+        self.calls[name]  = self.calls.get(name, 0) + 1
+        self.active[name] = self.active.get(name, 0) + 1
+        self.stack.append(self.clock())
+
+    def exit(self, func, pos, end):
+        name    = func.__name__
+        elapsed = self.clock() - self.stack.pop()
+        self.active[name] -= 1
+        if not self.active[name]:
+            self.time[name] = self.time.get(name, 0.0) + elapsed
+
+    def fail(self, func, pos):
+        name = func.__name__
+        self.backtracks[name] = self.backtracks.get(name, 0) + 1
+        self.exit(func, pos, pos)
+
+    def report(self):
+        """ return a table of the rules, the slowest first """
+        out = "{:<24}{:>10}{:>12}{:>12}\n".format("rule", "calls",
+                                                   "backtracks", "time")
+        for name in sorted(self.calls, key = lambda x: -self.time.get(x, 0)):
+            out += "{:<24}{:>10}{:>12}{:>12.6f}\n".format(
+                name, self.calls[name], self.backtracks.get(name, 0),
+                self.time.get(name, 0.0))
+        return out
+
 class InvalidParse(Exception):
     def __init__(self, *args, **kwargs):
         super(Exception, self).__init__(*args, **kwargs)
         self.function = None
 
 class ParseError(RuntimeError):
-    pass
+    def highlight(self, context_above = 0, context_below = 0):
+        """ return the source around the token the error was found at """
+        return self.args[1].highlight(context_above, context_below)
+
+def resync(parser, index, block = True):
+    """ skip tokens after a syntax error, starting with the one at index,
+        to where parsing can carry on. In a block that is past the next
+        newline, or before a } closing the block or a function. Outside
+        of any block it is before the next declaration. Braces opened on
+        the way are skipped whole.
+    """
+    tokens = parser.tokens
+    lcurly = literal_kind("{")
+    rcurly = literal_kind("}")
+    stops  = kind_mask("function") if block else kind_mask("function", "import", "struct")
+    first  = index
+    depth  = 0
+    while True:
+        try:
+            kind = tokens.kind(index)
+        except IndexError:
+            break
+        if kind == lcurly:
+            depth += 1
+        elif kind == rcurly:
+            if depth == 0 and block:
+                break
+            depth = max(0, depth - 1)
+        elif depth == 0 and index > first and stops >> kind & 1:
+            break
+        elif depth == 0 and block and kind == Newline.kind_id:
+            index += 1
+            break
+        index += 1
+    parser.pos = index - 1
+    parser.consume("\n")
+
+def first_set(*tests):
+    """ return one kind mask per token of lookahead, each test is a token
+        class or spelling, or a tuple of them.
+    """
+    return tuple(kind_mask(*test) if isinstance(test, tuple) else kind_mask(test)
+                 for test in tests)
+
+def dispatch_table(*alternatives):
+    """ map each token kind to the (rest of first set, rule) pairs of the
+        alternatives that can start with it, keeping the given order.
+    """
+    table = {}
+    for first, func in alternatives:
+        for kind in range(kind_count):
+            if first[0] >> kind & 1:
+                table.setdefault(kind, []).append((first[1:], func))
+    return table
+
+def predict(parser, table):
+    """ return the rules of a dispatch table selected by the next tokens """
+    try:
+        kind = parser.tokens.kind(parser.pos + 1)
+    except IndexError:
+        return ()
+    return [func for rest, func in table.get(kind, ())
+            if not rest or parser.lookahead(rest, 2)]
+
+def parse_predicted(parser, table):
+    """ parse the first of the predicted alternatives that succeeds, only
+        an alternative that fails part way through falls back to the next.
+    """
+    for func in predict(parser, table):
+        try:
+            return func(parser)
+        except InvalidParse:
+            pass
+    raise InvalidParse()
 
 @parsefunc
 def parse_identifier(parser):
@@ -119,7 +451,7 @@ def parse_type(parser):
 @parsefunc
 def parse_param_list(parser):
     out = ast.ParamList()
-    while True:
+    while parser.lookahead(decl_first):
         try:
             out.append(parse_decl(parser))
         except InvalidParse:
@@ -148,7 +480,7 @@ def parse_decl(parser):
         expr = parse_expression(parser)
     return ast.Decl(type, id, expr)
 
-@parsefunc
+@blockfunc
 def parse_for(parser):
     decl      = None
     invariant = None
@@ -157,10 +489,7 @@ def parse_for(parser):
     try:
         parser.accept("(")
         if not parser.peek(";"):
-            try:
-                decl = parse_decl(parser)
-            except InvalidParse:
-                decl = parse_expression(parser)
+            decl = parse_predicted(parser, for_init_table)
         parser.accept(";")
         if not parser.peek(";"):
             invariant = parse_expression(parser)
@@ -171,13 +500,13 @@ def parse_for(parser):
         parser.consume("\n")
         parser.accept("{")
         parser.consume("\n")
-        statements = parse_statement_list(parser) 
+        statements = yield parse_statement_list
         parser.accept("}")
-        return ast.For(decl, invariant, post, statements)
     except InvalidParse as e:
         raise ParseError("", parser.cur()), None, sys.exc_info()[2]
+    yield ast.For(decl, invariant, post, statements)
 
-@parsefunc
+@blockfunc
 def parse_if(parser):
     parser.accept("if")
     try:
@@ -187,7 +516,7 @@ def parse_if(parser):
         parser.consume("\n")
         parser.accept("{")
         parser.consume("\n")
-        success = parse_statement_list(parser)
+        success = yield parse_statement_list
         parser.accept("}")
         parser.consume("\n")
         if parser.peek("else"):
@@ -195,23 +524,24 @@ def parse_if(parser):
             parser.consume("\n")
             parser.accept("{")
             parser.consume("\n")
-            failure = parse_statement_list(parser)
+            failure = yield parse_statement_list
             parser.accept("}")
             parser.consume("\n")
         else:
             failure = None
-        return ast.If(cond = cond, success = success, failure = failure)
     except InvalidParse as e:
         raise ParseError("", parser.cur()), None, sys.exc_info()[2]
+    yield ast.If(cond = cond, success = success, failure = failure)
 
 @parsefunc
 def parse_return(parser):
     parser.accept("return")
     expr = None
-    try:
-        expr = parse_expression(parser)
-    except InvalidParse:
-        pass
+    if predict(parser, expression_table):
+        try:
+            expr = parse_expression(parser)
+        except InvalidParse:
+            pass
     parser.consume("\n")
     return ast.Return(expr)
 
@@ -227,33 +557,23 @@ def parse_func_call(parser):
     identifier = parse_identifier(parser)
     parser.accept("(")
     params = []
-    try:
-        params.append(parse_expression(parser))
-        while parser.peek(","):
-            parser.next()
+    if predict(parser, expression_table):
+        try:
             params.append(parse_expression(parser))
-    except InvalidParse:
-        pass
+            while parser.peek(","):
+                parser.next()
+                params.append(parse_expression(parser))
+        except InvalidParse:
+            pass
     parser.accept(")")
     return ast.FuncCall(identifier, params)
 
 @parsefunc
 def parse_atomic_expr(parser):
-    funcs = (parse_func_call,
-             parse_field_access,
-             parse_identifier,
-             parse_number,
-             parse_paren_expr,
-             parse_string,)
-    for func in funcs:
-        try:
-            return func(parser)
-        except InvalidParse:
-            pass
-    raise InvalidParse()
+    return parse_predicted(parser, atomic_table)
 
 def is_left_assoc(op):
-    return True
+    return not isinstance(op, AssignBase)
 
 def get_prec(op):
     prec_table = {
@@ -275,81 +595,112 @@ def get_prec(op):
     }
     return prec_table[op.value]
 
-def make_op(list_in):
-    optype = None
-    if isinstance(list_in[-1] , Op):
-        optype = ast.Op 
-    elif isinstance(list_in[-1] , Comp):
+def make_op(op, lhs, rhs):
+    if isinstance(op, Op):
+        optype = ast.Op
+    elif isinstance(op, Comp):
         optype = ast.Comp
-    elif isinstance(list_in[-1] , AssignBase):
+    else:
         optype = ast.Assign
+    node = optype(op.get_value(), lhs, rhs)
+    node.start, node.end = lhs.start, rhs.end
+    return node
 
-    if optype:
-        op_value = list_in.pop()
-        rhs = make_op(list_in)
-        lhs = make_op(list_in)
-        return optype(op_value.get_value(), lhs, rhs)
-    else:
-        return list_in.pop()
+def peek_operator(parser):
+    if parser.peek(Op, Comp, AssignBase):
+        return parser.peek()
+    return None
 
-@parsefunc
-def parse_expression(parser):
-    stack  = []
-    output = []
-    while not parser.peek("\n"):
-        if parser.peek(Op, Comp, AssignBase):
-            op1 = parser.next()
-            while len(stack):
-                op2 = stack[-1]
-                if (is_left_assoc(op1) and get_prec(op1) <= get_prec(op2)) or (get_prec(op1) < get_prec(op2)):
-                    output.append(stack.pop())
-                else:
-                    break
-            stack.append(op1)
+def parse_operand(parser):
+    if not predict(parser, atomic_table):
+        raise InvalidParse()
+    return parse_atomic_expr(parser)
+
+def parse_binary(parser, min_prec):
+    """ parse operands joined by operators of at least min_prec.
+        A run of operators at one level is folded in a loop, the parser
+        only recurses to go up a level, so the depth is bounded by the
+        number of levels rather than the length of the expression.
+    """
+    lhs = parse_operand(parser)
+    op  = peek_operator(parser)
+    while op is not None and get_prec(op) >= min_prec:
+        prec = get_prec(op)
+        if is_left_assoc(op):
+            parser.next()
+            lhs = make_op(op, lhs, parse_binary(parser, prec + 1))
+            op  = peek_operator(parser)
         else:
-            try:
-                output.append(parse_atomic_expr(parser))
-            except InvalidParse:
-                break
+            operands  = [lhs]
+            operators = []
+            while (op is not None and get_prec(op) == prec
+                                  and not is_left_assoc(op)):
+                parser.next()
+                operators.append(op)
+                operands.append(parse_binary(parser, prec + 1))
+                op = peek_operator(parser)
+            lhs = operands.pop()
+            while operators:
+                lhs = make_op(operators.pop(), operands.pop(), lhs)
+    return lhs
 
-    if output:
-        while stack:
-            output.append(stack.pop())
-        ret = make_op(output)
-        if(output):
-            raise InvalidParse()
-        return ret
-    else:
+@parsefunc
+def parse_expression(parser):
+    out = parse_binary(parser, 0)
+    if predict(parser, atomic_table):
+        # an operand straight after the expression makes it invalid, if
+        # what follows does not parse the expression ends before it.
+        pos = parser.pos
+        try:
+            parse_atomic_expr(parser)
+        except InvalidParse:
+            return out
+        parser.pos = pos
         raise InvalidParse()
+    return out
 
-@parsefunc
+@blockfunc
 def parse_statement(parser):
-    funcs = (parse_function,
-             parse_decl,
-             parse_expression,
-             parse_for,
-             parse_return,
-             parse_while,
-             parse_if,)
-    for func in funcs:
+    for func in predict(parser, statement_table):
         try:
-            return func(parser)
+            if hasattr(func, "steps"):
+                statement = yield func
+            else:
+                statement = func(parser)
         except InvalidParse:
-            pass
+            continue
+        yield statement
     raise InvalidParse()
 
-@parsefunc
+@blockfunc
 def parse_statement_list(parser):
     out = []
     while True:
-        try:
-            out.append(parse_statement(parser))
-            parser.consume("\n")
-        except InvalidParse:
+        if predict(parser, statement_table):
+            try:
+                out.append((yield parse_statement))
+                parser.consume("\n")
+                parser.commit()
+                continue
+            except InvalidParse:
+                if parser.errors is None:
+                    break
+                index = parser.pos + 1
+                error = ParseError("", parser[index])
+            except ParseError as e:
+                # only passed in by run_blocks when recovering
+                index = parser.pos
+                error = e
+        elif parser.errors is None or parser.done() or parser.peek("}"):
             break
-    return ast.StatementList(*out)
+        else:
+            index = parser.pos + 1
+            error = ParseError("", parser[index])
+        parser.errors.append(error)
+        resync(parser, index)
+    yield ast.StatementList(*out)
 
-@parsefunc
+@blockfunc
 def parse_function(parser):
     # function declaration 
     parser.accept("function")
@@ -368,17 +719,17 @@ def parse_function(parser):
         # start of function body
         parser.accept("{")
         parser.consume("\n")
-        statements = parse_statement_list(parser)
+        statements = yield parse_statement_list
         parser.consume("\n")
         parser.accept("}")
-        return ast.Function(name       = name,
-                            params     = params,
-                            ret_type   = ret_type,
-                            statements = statements)
     except InvalidParse as e:
         raise ParseError("", parser.cur()), None, sys.exc_info()[2]
+    yield ast.Function(name       = name,
+                       params     = params,
+                       ret_type   = ret_type,
+                       statements = statements)
 
-@parsefunc
+@blockfunc
 def parse_while(parser):
     parser.accept("while")
     try:
@@ -388,11 +739,11 @@ def parse_while(parser):
         parser.consume("\n")
         parser.accept("{")
         parser.consume("\n")
-        statements = parse_statement_list(parser)
+        statements = yield parse_statement_list
         parser.accept("}")
-        return ast.While(expr, statements)
     except InvalidParse:
         raise ParseError("", parser.cur()), None, sys.exc_info()[2]
+    yield ast.While(expr, statements)
 
 @parsefunc
 def parse_import(parser):
@@ -405,22 +756,28 @@ def parse_import(parser):
 def parse_program(parser):
     statements = []
     parser.consume("\n")
-    try:
-        while not parser.done():
-            for func in (parse_function, parse_import, parse_struct):
-                try:
-                    statements.append(func(parser))
-                    break
-                except InvalidParse:
-                    pass
-            else:
-                raise
+    while not parser.done():
+        try:
+            statements.append(parse_predicted(parser, declaration_table))
             parser.consume("\n")
-        return ast.Program(statements)
-    except ParseError as e:
-        print(e[1].highlight(10, 10))
-        raise
+            parser.commit()
+            continue
+        except InvalidParse:
+            if parser.errors is None:
+                raise
+            index = parser.pos + 1
+            error = ParseError("", parser[index])
+        except ParseError as e:
+            if parser.errors is None:
+                print(e[1].highlight(10, 10))
+                raise
+            index = parser.pos
+            error = e
+        parser.errors.append(error)
+        resync(parser, index, block = False)
+    return ast.Program(statements, getattr(parser.tokens, "source", None))
 
+@parsefunc
 def parse_struct(parser):
     parser.accept("struct")
     try:
@@ -437,15 +794,283 @@ def parse_struct(parser):
         parser.consume("\n")
         parser.accept("}")
         parser.consume("\n")
-        return ast.Struct(struct_name, field_list)
+        return ast.Struct(struct_name, *field_list)
     except InvalidParse:
         raise ParseError("", parser.cur()), None, sys.exc_info()[2]
 
-def parse(tokens):
-    parser  = Parser(tokens)
-    program = parse_program(parser)
-    program.make_tables()
-    return program
+# First sets for the rules that are chosen between. A rule is only tried
+# when the next tokens are in its first set, so alternatives that would
+# fail on their first token are never entered.
+decl_first       = first_set(Identifier, Identifier)
+expression_first = first_set((Identifier, Number, "(", String))
+
+atomic_table = dispatch_table(
+    (first_set(Identifier, "("), parse_func_call),
+    (first_set(Identifier, "."), parse_field_access),
+    (first_set(Identifier),      parse_identifier),
+    (first_set(Number),          parse_number),
+    (first_set("("),             parse_paren_expr),
+    (first_set(String),          parse_string),
+)
+
+expression_table = dispatch_table(
+    (expression_first, parse_expression),
+)
+
+for_init_table = dispatch_table(
+    (decl_first,       parse_decl),
+    (expression_first, parse_expression),
+)
+
+statement_table = dispatch_table(
+    (first_set("function"), parse_function),
+    (decl_first,            parse_decl),
+    (expression_first,      parse_expression),
+    (first_set("for"),      parse_for),
+    (first_set("return"),   parse_return),
+    (first_set("while"),    parse_while),
+    (first_set("if"),       parse_if),
+)
+
+declaration_table = dispatch_table(
+    (first_set("function"), parse_function),
+    (first_set("import"),   parse_import),
+    (first_set("struct"),   parse_struct),
+)
+
+# Programs of fewer tokens than this are parsed in one process.
+parallel_tokens = 1 << 16
+
+def declaration_starts(tokens):
+    """ return the index of the first token of each top level declaration,
+        found by matching { and } rather than by parsing.
+    """
+    lcurly = chr(literal_kind("{"))
+    rcurly = chr(literal_kind("}"))
+    kinds  = [lcurly, rcurly] + [chr(literal_kind(x))
+                                 for x in ("function", "import", "struct")]
+    pattern = re.compile("[" + "".join(re.escape(x) for x in kinds) + "]")
+    starts  = []
+    depth   = 0
+    for match in pattern.finditer(tokens.kinds.tostring()):
+        kind = match.group()
+        if kind == lcurly:
+            depth += 1
+        elif kind == rcurly:
+            depth -= 1
+        elif depth == 0:
+            starts.append(match.start())
+    return starts
+
+_worker_tokens  = None
+_worker_packrat = False
+def _init_worker(tokens, packrat):
+    global _worker_tokens, _worker_packrat
+    _worker_tokens  = tokens
+    _worker_packrat = packrat
+
+def _parse_chunk(chunk):
+    """ parse the declarations from token start up to end, returning them
+        pickled, or None if they do not parse or do not end at end.
+    """
+    start, end = chunk
+    parser = Parser(_worker_tokens, packrat = _worker_packrat)
+    parser.pos = start - 1
+    declarations = []
+    try:
+        while parser.pos + 1 < end:
+            declarations.append(parse_predicted(parser, declaration_table))
+            parser.consume("\n")
+            parser.commit()
+    except (InvalidParse, ParseError):
+        return None
+    if parser.pos + 1 != end:
+        return None
+    return pickle.dumps(declarations, 2)
+
+def parse_program_parallel(tokens, processes = None, threshold = None,
+                           packrat = False, errors = None):
+    """ parse_program() with the top level declarations split across a
+        pool of worker processes.
+
+        Programs shorter than threshold tokens (parallel_tokens by default)
+        are parsed in this process, as are programs a worker fails on so
+        that errors are reported as they would be without workers. errors
+        is passed to the Parser used for that.
+    """
+    if isinstance(tokens, (str, SourceFile)):
+        tokens = tokenise_stream(tokens)
+    if threshold is None:
+        threshold = parallel_tokens
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    parser = Parser(tokens, packrat = packrat, errors = errors)
+    if (processes < 2 or not isinstance(tokens, TokenStream)
+                      or len(tokens) < threshold):
+        return parse_program(parser)
+
+    starts = declaration_starts(tokens)
+    parser.consume("\n")
+    if not starts or starts[0] != parser.pos + 1:
+        return parse_program(parser)
+    # a few chunks per process so one slow chunk does not hold up the rest
+    size   = len(tokens) // (processes * 4) + 1
+    chunks = []
+    first  = starts[0]
+    for start in starts[1:]:
+        if start - first >= size:
+            chunks.append((first, start))
+            first = start
+    chunks.append((first, len(tokens)))
+
+    pool = multiprocessing.Pool(processes, _init_worker, (tokens, packrat))
+    try:
+        results = pool.map(_parse_chunk, chunks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    if None in results:
+        return parse_program(parser)
+
+    # the collector would otherwise run over and over while the many new
+    # nodes are loaded, while none of them can be garbage yet
+    statements = []
+    enabled    = gc.isenabled()
+    gc.disable()
+    try:
+        for result in results:
+            statements.extend(pickle.loads(result))
+    finally:
+        if enabled:
+            gc.enable()
+    return ast.Program(statements, tokens.source)
+
+def shift_positions(node, delta):
+    """ move the start and end of node and everything under it on by
+        delta characters, nodes that were not parsed are left at -1.
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (list, tuple)):
+            stack.extend(node)
+            continue
+        if not isinstance(node, ast.AST):
+            continue
+        if node.start >= 0:
+            node.start += delta
+            node.end   += delta
+        # only the node's own fields, the others may lead to nodes that
+        # were not parsed again or back to this one
+        cls = type(node)
+        for name in cls.child_fields + cls.name_fields:
+            stack.append(getattr(node, name))
+
+def reparse_program(tokens, previous, edits, packrat = False, hook = None,
+                    errors = None):
+    """ parse_program() for a source made by applying edits to the source
+        of the previous program. edits are (offset, removed, inserted)
+        tuples applied in turn, as in SourceFile.edit().
+
+        Each top level declaration covers the text from the end of the one
+        before it up to the start of the one after it. Only those an edit
+        touches are parsed again, the others are taken from previous and
+        moved to their new offsets, so previous should not be used after.
+        If the edited text does not split into the same declarations the
+        whole program is parsed, with errors passed to its Parser.
+    """
+    if isinstance(tokens, (str, SourceFile)):
+        tokens = tokenise_stream(tokens)
+    parser = Parser(tokens, packrat = packrat, hook = hook)
+    decls  = previous.statements
+    if (not isinstance(tokens, TokenStream) or not decls or
+        any(x.start < 0 for x in decls)):
+        return parse_program(Parser(tokens, packrat = packrat, hook = hook,
+                                    errors = errors))
+
+    count  = len(decls)
+    lows   = [0] + [x.end for x in decls[:-1]]
+    highs  = [x.start for x in decls[1:]] + [sys.maxint]
+    deltas = [0] * count
+    dirty  = [False] * count
+    for offset, removed, inserted in edits:
+        delta = len(inserted) - removed
+        for i in range(count):
+            if offset <= highs[i] and offset + removed >= lows[i]:
+                dirty[i] = True
+            elif offset + removed < lows[i]:
+                lows[i]   += delta
+                highs[i]  += delta
+                deltas[i] += delta
+
+    starts = tokens.starts
+    def token_at(offset):
+        index = bisect_left(starts, offset)
+        if index < len(starts) and starts[index] == offset:
+            return index
+        return None
+
+    def token_before(offset):
+        index = bisect_left(starts, offset) - 1
+        if index >= 0 and tokens.span(index, index)[1] == offset:
+            return index
+        return None
+
+    statements = []
+    i = 0
+    while i < count:
+        if not dirty[i]:
+            decl  = decls[i]
+            delta = deltas[i]
+            if (token_at(decl.start + delta) is None or
+                token_before(decl.end + delta) is None):
+                return parse_program(Parser(tokens, packrat = packrat, hook = hook,
+                                            errors = errors))
+            if delta:
+                shift_positions(decl, delta)
+            statements.append(decl)
+            i += 1
+            continue
+        # parse the text between the clean declarations either side
+        j = i
+        while j < count and dirty[j]:
+            j += 1
+        start = token_before(decls[i - 1].end) if i else -1
+        stop  = token_at(decls[j].start + deltas[j]) if j < count else len(tokens)
+        if start is None or stop is None:
+            return parse_program(Parser(tokens, packrat = packrat, hook = hook,
+                                        errors = errors))
+        parser.pos = start
+        parser.consume("\n")
+        try:
+            while parser.pos + 1 < stop:
+                statements.append(parse_predicted(parser, declaration_table))
+                parser.consume("\n")
+                parser.commit()
+        except (InvalidParse, ParseError):
+            parser.pos = None
+        if parser.pos is None or parser.pos + 1 != stop:
+            # report errors the way a whole parse does
+            return parse_program(Parser(tokens, packrat = packrat, hook = hook,
+                                        errors = errors))
+        i = j
+    return ast.Program(statements, tokens.source)
+
+def parse(tokens, window = None, packrat = False, hook = None, jobs = 1,
+          previous = None, edits = (), errors = None):
+    """ parse a program, its symbol tables are built along with the type
+        checks by Program.sema(). If jobs is more than one the declarations
+        are parsed in that many processes, see parse_program_parallel().
+        If previous is given tokens is its source after edits, see
+        reparse_program(). If errors is a list every syntax error is added
+        to it and what could be parsed is returned.
+    """
+    if previous is not None:
+        return reparse_program(tokens, previous, edits, packrat, hook, errors)
+    if jobs > 1 and not window and hook is None:
+        return parse_program_parallel(tokens, jobs, packrat = packrat,
+                                      errors = errors)
+    return parse_program(Parser(tokens, window, packrat, hook, errors))
 
 if __name__ == "__main__":
     import argparse
@@ -453,4 +1078,4 @@ if __name__ == "__main__":
     function a()
     {}
     """
-    parse(test).output_graph("out.png")
+    parse(test).output_graph("out.dot")
@@ -0,0 +1,374 @@
+#!/usr/bin/env python2.7
+import syntax_tree as ast
+from   symbol_table import *
+from   visitor      import Pass
+
+class TablesPass(Pass):
+    """ TablesPass builds the symbol tables, giving every node the table
+        it is in as its symbol_table.
+
+        The table of a node is set by its parent before the node is
+        entered, nodes that open a scope set their own table in its place
+        and close it when left. The body of a function, an if or a while
+        is opened as a block when it is entered, after what comes before
+        it has been walked.
+    """
+    def __init__(self, builtins = None):
+        super(TablesPass, self).__init__()
+        self.builtins = builtins
+        self.blocks   = set()
+
+    def inherit(self, node):
+        """ put the children of node in the same table as it """
+        table = node.symbol_table
+        for name in node.child_fields:
+            value = getattr(node, name)
+            if isinstance(value, (list, tuple)):
+                for x in value:
+                    x.symbol_table = table
+            elif value is not None:
+                value.symbol_table = table
+
+    enter_Return        = inherit
+    enter_Binop         = inherit
+    enter_ParamList     = inherit
+
+    def enter_Program(self, node):
+        table = SymbolTable(builtins = self.builtins or builtin_table())
+        node.symbol_table = table
+        # declared up front so calls may come before the function
+        for s in node.statements:
+            if isinstance(s, (ast.Function, ast.Struct)):
+                table[s.name] = s
+        self.inherit(node)
+
+    def block(self, node, table):
+        """ make node a block inside table """
+        node.symbol_table = table
+        self.blocks.add(id(node))
+
+    def enter_StatementList(self, node):
+        if id(node) in self.blocks:
+            node.symbol_table = SubTable(node.symbol_table)
+        self.inherit(node)
+
+    def leave_StatementList(self, node):
+        if id(node) in self.blocks:
+            self.blocks.remove(id(node))
+            node.symbol_table.close()
+
+    def enter_Function(self, node):
+        table = node.symbol_table
+        if table.local(node.name) is not node:
+            table[node.name] = node
+        node.name.symbol_table     = table
+        node.ret_type.symbol_table = table
+        node.ret_type.identifier.symbol_table = table
+        node.symbol_table = ParamTable(table)
+        node.params.symbol_table = node.symbol_table
+        self.block(node.statements, node.symbol_table)
+
+    def leave_Function(self, node):
+        node.symbol_table.close()
+
+    def enter_If(self, node):
+        node.cond.symbol_table = node.symbol_table
+        self.block(node.success, node.symbol_table)
+        if node.failure:
+            self.block(node.failure, node.symbol_table)
+
+    def enter_FuncCall(self, node):
+        node.identifier.symbol_table = node.symbol_table
+        self.inherit(node)
+
+    def enter_Type(self, node):
+        node.identifier.symbol_table = node.symbol_table
+
+    def enter_For(self, node):
+        node.symbol_table = SubTable(node.symbol_table)
+        self.inherit(node)
+
+    def leave_For(self, node):
+        node.symbol_table.close()
+
+    def enter_While(self, node):
+        node.cond.symbol_table = node.symbol_table
+        self.block(node.statements, node.symbol_table)
+
+    def enter_Decl(self, node):
+        node.var.symbol_table = node.symbol_table
+        self.inherit(node)
+
+    def leave_Decl(self, node):
+        try:
+            node.symbol_table[node.var] = node
+        except KeyError:
+            #TODO: Add a better error message
+            msg = ""
+            raise ast.SemaMultipleDeclarationError(msg)
+
+    def enter_Struct(self, node):
+        table = node.symbol_table
+        if table.local(node.name) is not node:
+            table[node.name] = node
+
+class TypeRegistry(object):
+    """ TypeRegistry interns the types of a program, keeping one Type for
+        each name so that types are compared by identity. The builtin types
+        are shared by every registry, each struct is a type of its own.
+    """
+    def __init__(self):
+        self.types   = dict(ast.builtin_types)
+        self.structs = {}
+
+    def intern(self, name):
+        """ return the canonical type called name """
+        try:
+            return self.types[name]
+        except KeyError:
+            type = self.types[name] = ast.Type(name)
+            return type
+
+    def resolve(self, node):
+        """ return the canonical type of a Type node, kept as its expr_type """
+        node.expr_type = self.intern(node.identifier.value)
+        return node.expr_type
+
+    def type_of(self, node):
+        """ return the canonical type of a Type node that may not belong to
+            the program, such as those of the builtins shared by every
+            compilation, leaving the node as it is.
+        """
+        return self.intern(node.identifier.value)
+
+    def declare_struct(self, struct):
+        struct.expr_type = self.intern(struct.name.value)
+        self.structs[struct.name.value] = struct
+        return struct.expr_type
+
+    def field_type(self, type, identifier):
+        """ return the canonical type of the field identifier of type """
+        try:
+            struct = self.structs[type.identifier.value]
+        except (AttributeError, KeyError):
+            msg = "{} is not a struct".format(type)
+            raise ast.SemaTypeResolveError(msg)
+        for field in struct.fields:
+            if field.name == identifier:
+                return self.resolve(field.type)
+        msg = "struct {} has no field '{}'".format(struct.name, identifier)
+        raise ast.SemaIdentifierUndefinedError(msg)
+
+class Frame(object):
+    """ Frame holds the variables of a function, each is given the next
+        slot in it as it is declared. names and types hold the name each
+        slot has in the TAC and its type.
+
+        The names in a frame are unique, a variable with the name of one
+        already in it is named with a "'" and its slot added.
+    """
+    def __init__(self):
+        self.names = []
+        self.types = []
+        self.taken = set()
+
+    def add(self, name, type):
+        """ return the (frame, slot) of a new slot for name, which is kept
+            as the slot of name and of the name it has in the TAC.
+        """
+        slot = name.slot = (self, len(self.names))
+        if name.value in self.taken:
+            name = name.suffix("'{}".format(slot[1]))
+            name.slot = slot
+        self.taken.add(name.value)
+        self.names.append(name)
+        self.types.append(type)
+        return slot
+
+    def copy(self):
+        """ return a frame with the slots of this one, that more may be
+            added to without changing it.
+        """
+        out = Frame()
+        out.names = list(self.names)
+        out.types = list(self.types)
+        out.taken = set(self.taken)
+        return out
+
+    def __len__(self):
+        return len(self.names)
+
+class ResolvePass(Pass):
+    """ ResolvePass binds every use of an identifier to what declares it,
+        the symbol tables must be built first or by a TablesPass earlier
+        in the same walk.
+
+        Each variable is given a slot in the frame of its function, an
+        identifier naming a variable is given the same (frame, slot) so
+        that later passes need not look it up again, see Frame for the
+        names they have in the TAC.
+    """
+    def __init__(self):
+        super(ResolvePass, self).__init__()
+        self.frames = []
+
+    def bind(self, node, table, error, msg):
+        value = table.lookup(node)
+        if value is None:
+            raise error(msg.format(node.value))
+        node.binding = value
+        if isinstance(value, ast.Decl):
+            node.slot = value.var.slot
+        return value
+
+    def enter_Function(self, node):
+        node.frame = Frame()
+        self.frames.append(node.frame)
+
+    def leave_Function(self, node):
+        self.frames.pop()
+
+    def leave_Decl(self, node):
+        node.var.binding = node
+        if self.frames:
+            self.frames[-1].add(node.var, node.type)
+
+    def leave_Identifier(self, node):
+        self.bind(node, node.symbol_table, ast.SemaIdentifierUndefinedError,
+                  "Identifier '{}' cannot be found in the current scope.")
+
+    def leave_FuncCall(self, node):
+        self.bind(node.identifier, node.symbol_table,
+                  ast.SemaFunctionUndefinedError, "function {} cannot be found.")
+
+    def leave_FieldAccess(self, node):
+        self.bind(node.identifiers[0], node.symbol_table,
+                  ast.SemaIdentifierUndefinedError,
+                  "Identifier '{}' cannot be found in the current scope.")
+
+class SemaData(object):
+    def __init__(self):
+        self.ret_type = None
+
+class SemaPass(Pass):
+    """ SemaPass checks the types of the program, the symbol tables must
+        be built first or by a TablesPass earlier in the same walk.
+
+        The canonical type of each expression is kept as its expr_type,
+        for the passes after it to use.
+    """
+    def __init__(self, data = None, types = None):
+        super(SemaPass, self).__init__()
+        self.data       = data if data else SemaData()
+        self.types      = types if types else TypeRegistry()
+        self.ret_types  = []
+        self.int        = self.types.intern("int")
+        self.void       = self.types.intern("void")
+
+    def default_leave(self, node):
+        raise NotImplementedError(type(node).__name__)
+
+    def enter_Program(self, node):
+        # declared up front so structs may be used before they are
+        for s in node.statements:
+            if isinstance(s, ast.Struct):
+                self.types.declare_struct(s)
+
+    def leave_Program(self, node):
+        pass
+
+    def leave_StatementList(self, node):
+        pass
+
+    def leave_ParamList(self, node):
+        pass
+
+    def enter_Function(self, node):
+        self.ret_types.append(self.data.ret_type)
+        self.data.ret_type = self.types.resolve(node.ret_type)
+
+    def leave_Function(self, node):
+        self.data.ret_type = self.ret_types.pop()
+
+    def leave_If(self, node):
+        ast.resolve_type(node.cond.expr_type, self.int)
+
+    def leave_Return(self, node):
+        data = self.data
+        if node.statement:
+            type0 = node.statement.expr_type
+            # Check if we are returning from a void function
+            if data.ret_type is self.void:
+                msg = "Returning value from void function"
+                raise ast.SemaReturnValueFromVoidError(msg)
+            # Check that the return type matched the data returned.
+            try:
+                ast.resolve_type(type0, data.ret_type)
+            except ast.SemaTypeResolveError:
+                raise ast.SemaIncorrectReturnTypeError("{} {}".format(type0, data.ret_type))
+        elif data.ret_type is not self.void:
+            #TODO: Improve the error message given.
+            msg = "No return value given"
+            raise ast.SemaNoReturnValueError(msg)
+
+    def leave_Binop(self, node):
+        node.expr_type = ast.resolve_type(node.lhs.expr_type,
+                                          node.rhs.expr_type, node.optype)
+
+    def leave_Import(self, node):
+        pass
+
+    def leave_FuncCall(self, node):
+        function = node.identifier.binding
+        if not isinstance(function, ast.Function):
+            msg = "identifier {} is not a function".format(function)
+            raise ast.SemaCallingNonFunctionError(msg)
+        if len(function.params) != len(node.params):
+            raise ast.SemaParamMismatchError(
+                      "number of arguments to function does not match")
+        # function may be a builtin, see TypeRegistry.type_of()
+        for decl, param in zip(function.params, node.params):
+            ast.resolve_type(self.types.type_of(decl.type), param.expr_type)
+        node.expr_type = self.types.type_of(function.ret_type)
+
+    def leave_For(self, node):
+        if node.invariant:
+            ast.resolve_type(node.invariant.expr_type, self.int)
+
+    def leave_While(self, node):
+        ast.resolve_type(node.cond.expr_type, self.int)
+
+    def leave_Decl(self, node):
+        if node.expr:
+            ast.resolve_type(self.types.resolve(node.type), node.expr.expr_type)
+
+    def type_of_binding(self, node):
+        value = node.binding
+        if isinstance(value, ast.Decl):
+            return self.types.resolve(value.type)
+        return value
+
+    def leave_Identifier(self, node):
+        node.expr_type = self.type_of_binding(node)
+
+    def leave_FieldAccess(self, node):
+        type = self.type_of_binding(node.identifiers[0])
+        for identifier in node.identifiers[1:]:
+            type = self.types.field_type(type, identifier)
+        node.expr_type = type
+
+    def leave_Struct(self, node):
+        pass
+
+    def leave_Literal(self, node):
+        pass
+
+    def leave_String(self, node):
+        node.expr_type = self.types.intern("string")
+
+    def leave_Integer(self, node):
+        node.expr_type = self.int
+
+    def leave_Float(self, node):
+        #TODO: Change to correct type.
+        node.expr_type = self.int
@@ -0,0 +1,123 @@
+#!/usr/bin/env python2.7
+from array  import array
+from bisect import bisect_right
+
+class SourceFile(object):
+    """ SourceFile holds the text of one source along with a table of
+        the offsets at which each line starts, so that positions can be
+        mapped to lines without splitting the whole text.
+
+        If only a path is given the text is not kept, lines are read
+        back from the file when they are asked for.
+    """
+    def __init__(self, text = None, path = None):
+        assert text is not None or path is not None
+        self.text         = text
+        self.path         = path
+        self._line_starts = None
+
+    @classmethod
+    def from_path(cls, path):
+        return cls(open(path).read(), path)
+
+    @property
+    def line_starts(self):
+        if self._line_starts is None:
+            self._line_starts = self.index_lines()
+        return self._line_starts
+
+    def index_lines(self):
+        starts = array("i", [0])
+        if self.text is not None:
+            find  = self.text.find
+            index = find("\n")
+            while index != -1:
+                starts.append(index + 1)
+                index = find("\n", index + 1)
+        else:
+            base = 0
+            with open(self.path) as f:
+                for chunk in iter(lambda: f.read(1 << 16), ""):
+                    find  = chunk.find
+                    index = find("\n")
+                    while index != -1:
+                        starts.append(base + index + 1)
+                        index = find("\n", index + 1)
+                    base += len(chunk)
+        return starts
+
+    def edit(self, offset, removed, inserted):
+        """ return a new SourceFile with `removed` characters at `offset`
+            replaced by `inserted`, the line index is updated in place of
+            being rebuilt when it exists.
+        """
+        text   = self.text[:offset] + inserted + self.text[offset + removed:]
+        edited = SourceFile(text, self.path)
+        if self._line_starts is not None:
+            starts = self._line_starts
+            delta  = len(inserted) - removed
+            head   = bisect_right(starts, offset)
+            tail   = bisect_right(starts, offset + removed)
+            new    = array("i", starts[:head])
+            index  = inserted.find("\n")
+            while index != -1:
+                new.append(offset + index + 1)
+                index = inserted.find("\n", index + 1)
+            new.extend(x + delta for x in starts[tail:])
+            edited._line_starts = new
+        return edited
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        return self.text[index]
+
+    def line_count(self):
+        return len(self.line_starts)
+
+    def location(self, offset):
+        """ return the (line, column) of an offset """
+        line = bisect_right(self.line_starts, offset) - 1
+        return line, offset - self.line_starts[line]
+
+    def offset(self, line, column = 0):
+        return self.line_starts[line] + column
+
+    def line(self, lineno):
+        """ return the text of a line without its newline """
+        return self.lines(lineno, lineno + 1)[0]
+
+    def lines(self, first, last):
+        """ return the text of lines first up to, but not including, last """
+        starts = self.line_starts
+        last   = min(last, len(starts))
+        if first >= last:
+            return []
+        begin = starts[first]
+        end   = starts[last] if last < len(starts) else None
+        if self.text is not None:
+            text = self.text[begin:end]
+        else:
+            with open(self.path) as f:
+                f.seek(begin)
+                text = f.read() if end is None else f.read(end - begin)
+        if end is not None:
+            text = text[:-1]
+        return text.split("\n")
+
+    def highlight(self, lineno, pos, length = 1,
+                  context_above = 0, context_below = 0):
+        """ return the line with a marker under the given span, with
+            context lines around it.
+        """
+        assert context_above >= 0 and context_below >= 0
+        first = max(0, lineno - context_above)
+        lines = self.lines(first, lineno + context_below + 1)
+        out = ""
+        for line in lines[:lineno - first + 1]:
+            out += line + "\n"
+        out += " " * pos + "^" + "~" * (length - 1) + "\n"
+        for line in lines[lineno - first + 1:]:
+            out += line + "\n"
+        return out
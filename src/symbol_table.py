@@ -1,51 +1,121 @@
 #!/usr/bin/env python2.7
 import syntax_tree as ast
-from   collections import OrderedDict
 
-_global_symbol_table = None
+class Scopes(object):
+    """ Scopes holds what is declared in a chain of open SymbolTables,
+        as one map from each name to the stack of (table, value) of the
+        tables declaring it, the innermost last.
+    """
+    def __init__(self, outer):
+        self.names  = {}
+        self.tables = []
+        # the table looked in for names not declared in any of these
+        self.outer  = outer
+
+class SymbolTableClosedError(RuntimeError):
+    pass
 
 class SymbolTable(object):
     """ SymbolTable contains the mapping of identifiers to types
         it can contain point to one of
         function or type
-    """
-    def __init__(self, parent = None):
-        #TODO: remove this ugly hack
-        global _global_symbol_table
-        init_global_symbol_table()
 
-        self.data     = OrderedDict()
+        A table opens a scope inside its parent, closing any other scope
+        open there, the tables under one root share a single Scopes so
+        a lookup is a single dict access. Names are declared in the
+        innermost open table, and a table can only be looked in while it
+        is open, closing it removes all that was declared in it. Using a
+        closed table raises a SymbolTableClosedError.
+
+        A root table looks in builtins, see builtin_table(), for the names
+        not declared under it.
+    """
+    def __init__(self, parent = None, builtins = None):
         if parent:
-            parent.children.append(self)
+            self.scopes = parent.scopes
+            self.depth  = parent.depth + 1
+        else:
+            self.scopes = Scopes(builtins)
+            self.depth  = 0
 
-        self.parent   = parent if parent else _global_symbol_table
-        self.children = []
+        self.parent   = parent if parent else builtins
+        self.declared = []
+        self.open()
 
+    def open(self):
+        tables = self.scopes.tables
+        while tables and tables[-1] is not self.parent:
+            tables[-1].close()
+        tables.append(self)
+        self.closed = False
+
+    def check_open(self):
+        if self.closed:
+            raise SymbolTableClosedError("symbol table used after it was closed")
+
+    def close(self):
+        """ close the table and those opened inside it """
+        scopes = self.scopes
+        if self not in scopes.tables:
+            return
+        table = None
+        while table is not self:
+            table = scopes.tables.pop()
+            for key in table.declared:
+                stack = scopes.names[key]
+                stack.pop()
+                if not stack:
+                    del scopes.names[key]
+            table.declared = []
+            table.closed   = True
 
     def __getitem__(self, key):
-        try:
-            return self.data[key]
-        except KeyError as e:
-            if self.parent:
-                return self.parent[key]
-            raise
+        value = self.lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def lookup(self, key):
+        """ return the value of key in the table or the nearest of its
+            parents that has it, or None if none do.
+        """
+        self.check_open()
+        stack = self.scopes.names.get(key)
+        if stack:
+            table, value = stack[-1]
+            if table.depth <= self.depth:
+                return value
+            # declared in tables opened inside this one
+            for table, value in reversed(stack):
+                if table.depth <= self.depth:
+                    return value
+        if self.scopes.outer:
+            return self.scopes.outer.lookup(key)
+        return None
+
+    def local(self, key):
+        """ return the value of key declared in the table itself, or None """
+        self.check_open()
+        stack = self.scopes.names.get(key)
+        if stack and stack[-1][0] is self:
+            return stack[-1][1]
+        return None
 
     def __setitem__(self, key, value):
-        assert(isinstance(value, (ast.Function, ast.Type, ast.Struct)))
+        assert(isinstance(value, (ast.Function, ast.Type, ast.Struct, ast.Decl)))
         assert(isinstance(key, ast.Identifier))
-        if key in self.data.keys():
+        self.check_open()
+        stack = self.scopes.names.setdefault(key, [])
+        if stack and stack[-1][0] is self:
             raise KeyError()
-        self.data[key] = value
-
-    def set_parent(self, parent):
-        assert isinstance(parent, SymbolTable)
-        self.parent = parent
+        stack.append((self, value))
+        self.declared.append(key)
 
     def __str__(self):
         out = ""
         if self.parent:
             out = str(self.parent)
-        out += str(self.data) + "\n"
+        out += str(dict((key, self.local(key)) for key in self.declared)) + "\n"
         return out
 
 class ParamTable(SymbolTable):
@@ -55,29 +125,10 @@ class SubTable(SymbolTable):
     pass
 
 
-def dummy_function(name, return_type_name, *args):
-    return_type = ast.Type(ast.Identifier(return_type_name))
-    params = []
-    for i, j in enumerate(args):
-        param_name = "param_{}".format(i)
-        params.append(ast.Decl(ast.Type(j),
-                               ast.Identifier(param_name),
-                               None))
-        
-    return ast.Function(ast.Identifier(name),
-                        ast.ParamList(*params),
-                        return_type,
-                        ast.StatementList())
-
-def add_dummy_function(name, return_type, *args):
-    _global_symbol_table[ast.Identifier(name)] = \
-                dummy_function(name, return_type, *args)
-def init_global_symbol_table():
-    global _global_symbol_table
-    if not _global_symbol_table:
-        _global_symbol_table = True
-        _global_symbol_table = SymbolTable()
-        _global_symbol_table.parent = None
-        add_dummy_function("print", "void", "int")
-        add_dummy_function("prints", "void", "string")
-        add_dummy_function("putc", "void", "int")
+def builtin_table(cache = None):
+    """ return the table of the functions every program has, declared by
+        the stdlib interface, see interface.load_interface(). It is only
+        looked in once made so it is shared between compilations.
+    """
+    from interface import load_interface
+    return load_interface(cache = cache)
@@ -1,23 +1,28 @@
 #!/usr/bin/env python2.7
-import functools
-import pydot
+import passes
 import tac
+from graph        import Graph
 from symbol_table import *
+from visitor      import PassManager
 
-node_counter = 0
 def make_node(name, graph):
-    global node_counter
-    node = pydot.Node("{}".format(node_counter), label='"{}"'.format(name))
-    graph.add_node(node)
-    node_counter += 1
-    return node
+    # syntax tree nodes are drawn in the graphviz default shape
+    return graph.add_node(name, shape = None)
 
 def add_edge(graph, node0, node1, label = ""):
-    graph.add_edge(pydot.Edge(node0, node1, label='"{}"'.format(label)))
-
-class SemaData(object):
-    def __init__(self):
-        self.ret_type = None
+    graph.add_edge(node0, node1, label)
+
+def child_graph(node, graph):
+    """ add node and everything under it to graph, or a single "..." node
+        in its place if it is deeper than graph.max_depth.
+    """
+    if graph.max_depth is not None and graph.depth >= graph.max_depth:
+        return make_node("...", graph)
+    graph.depth += 1
+    try:
+        return node.make_graph(graph)
+    finally:
+        graph.depth -= 1
 
 class SemaError(RuntimeError):
     def __init__(self, message):
@@ -50,158 +55,199 @@ class SemaIncorrectReturnTypeError(SemaError):
 class SemaTypeResolveError(SemaError):
     pass
 
-
-def semafunc(function):
-    @functools.wraps(function)
-    def wrap(*args, **kwargs):
-        try:
-            retval = function(*args, **kwargs)
-        except Exception as e:
-            if not hasattr(e, "ast"):
-                e.ast = args[0]
-            raise
-        return retval 
-    return wrap
-
 class AST(object):
+    """ Base of every syntax tree node. Nodes keep no __dict__, each class
+        lists its fields in __slots__ and sets them all in __init__ after
+        calling the __init__ of its base.
+
+        start and end are the offsets in the source of the first character
+        of the node and of the character after it, or -1 when the node was
+        not parsed from a source.
+
+        expr_type is the canonical type sema found for an expression, and
+        for a Type node the canonical type it names, see TypeRegistry in
+        passes. It is None until sema has run.
+
+        child_fields names the fields holding the nodes that passes walk
+        into, see visitor.PassManager. name_fields names those holding the
+        names and types written in the node, which are part of its source
+        but not walked into. Every other field holding a node points out
+        of the node, such as Identifier.binding.
+    """
+    __slots__    = ("symbol_table", "parent", "start", "end", "expr_type")
+    child_fields = ()
+    name_fields  = ()
+
     def __init__(self):
         self.symbol_table = None
         self.parent       = None
-        self.start_token  = None
-        self.end_token    = None
+        self.start        = -1
+        self.end          = -1
+        self.expr_type    = None
 
     def __repr__(self):
         return "ast.{}".format(type(self).__name__)
 
-    def output_graph(self, filename):
-        graph = pydot.Dot(graph_type="digraph")
-        self.make_graph(graph)
-        graph.write_png(filename)
+    def highlight(self, source, context_above = 0, context_below = 0):
+        """ return the first line of the node from source with the node
+            marked, see SourceFile.highlight().
+        """
+        line, pos = source.location(self.start)
+        if line + 1 < source.line_count():
+            end = min(self.end, source.offset(line + 1) - 1)
+        else:
+            end = self.end
+        return source.highlight(line, pos, max(1, end - self.start),
+                                context_above, context_below)
+
+    def output_graph(self, filename, max_depth = None):
+        """ write the node and everything under it to filename in the DOT
+            language as it is walked, leaving out nodes more than max_depth
+            below it. See graph.render() to draw the file.
+        """
+        with Graph(filename, max_depth) as graph:
+            self.make_graph(graph)
 
     def make_graph(self, graph):
         raise NotImplementedError(type(self).__name__)
 
     def make_tables(self, table = None):
-        raise NotImplementedError(type(self).__name__)
+        """ build the symbol tables of the node and everything under it
+            within table.
+        """
+        self.symbol_table = table
+        PassManager(passes.TablesPass()).run(self)
 
-    @semafunc
-    def sema(self, data):
-        raise NotImplementedError(type(self).__name__)
+    def sema(self, data = None):
+        """ check the types of the node and everything under it, the
+            symbol tables must have been built.
+        """
+        PassManager(passes.ResolvePass(), passes.SemaPass(data)).run(self)
 
     def make_tac(self, state):
+        """ emit the TAC of the node to state, see tac.TacState.emit() """
         raise NotImplementedError(type(self).__name__)
 
 class Program(AST):
-    def __init__(self, statements):
+    __slots__    = ("statements", "source", "types")
+    child_fields = ("statements",)
+
+    def __init__(self, statements, source = None):
         super(Program, self).__init__()
         self.statements = statements
+        self.source     = source
+        self.types      = None
+
+    def output_function_graphs(self, pattern, max_depth = None):
+        """ write each function to a DOT file of its own, named by putting
+            the function name into pattern. return the names written.
+        """
+        names = []
+        for s in self.statements:
+            if isinstance(s, Function):
+                names.append(pattern.format(s.name))
+                s.output_graph(names[-1], max_depth)
+        return names
 
     def make_graph(self, graph):
-        global node_count
-        node_count = 0
         node0 = make_node("Top", graph)
         for s in self.statements:
-            node1 = s.make_graph(graph)
+            node1 = child_graph(s, graph)
             add_edge(graph, node0, node1)
         return node0
 
     def make_tac(self, state):
-        out = []
-        for s in self.statements:
-            out += s.make_tac(state)
-        return out
-
-    def make_tables(self, table = None):
-        self.symbol_table = SymbolTable()
-        for s in self.statements:
-            s.make_tables(self.symbol_table)
-
-    @semafunc
-    def sema(self, data = None):
-        if not data:
-            data = SemaData()
+        """ emit the TAC of the program to state, returning state.code """
         for s in self.statements:
-            s.sema(data)
+            s.make_tac(state)
+        return state.code
+
+    def sema(self, data = None, builtins = None):
+        """ build the symbol tables, resolve the identifiers and check the
+            types of the program, in a single walk over it. The types used
+            are kept as types. builtins is the table of builtin functions,
+            a new one is made if it is not given.
+        """
+        self.types = passes.TypeRegistry()
+        PassManager(passes.TablesPass(builtins), passes.ResolvePass(),
+                    passes.SemaPass(data, self.types)).run(self)
 
 class StatementList(AST):
+    __slots__    = ("statements",)
+    child_fields = ("statements",)
+
     def __init__(self, *statements):
         super(StatementList, self).__init__()
         self.statements = statements
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        for s in self.statements:
-            s.make_tables(self.symbol_table)
-
     def __iter__(self):
         return iter(self.statements)
 
-    @semafunc
-    def sema(self, data):
-        for s in self:
-            s.sema(data)
-
     def make_tac(self, state):
-        out = []
         for s in self:
-            out += s.make_tac(state)
-        return out
+            s.make_tac(state)
 
 class Function(AST):
+    __slots__    = ("name", "params", "ret_type", "statements", "frame")
+    child_fields = ("params", "statements")
+    name_fields  = ("name", "ret_type")
+
     def __init__(self, name, params, ret_type, statements):
         super(Function, self).__init__()
         self.name       = name
         self.params     = params
         self.ret_type   = ret_type
         self.statements = statements
+        self.frame      = None
 
     def make_graph(self, graph):
         node0 = make_node("function {}".format(str(self.name)), graph)
         for x in self.params:
             node1  = make_node("param", graph)
-            node2 = x.type.make_graph(graph)
-            node3 = x.var.make_graph(graph)
+            node2 = child_graph(x.type, graph)
+            node3 = child_graph(x.var, graph)
             add_edge(graph, node0, node1)
             add_edge(graph, node1, node2)
             add_edge(graph, node1, node3)
 
         if self.ret_type:
-            node1 = self.ret_type.make_graph(graph)
+            node1 = child_graph(self.ret_type, graph)
             add_edge(graph, node0, node1, "returns")
 
         for s in self.statements:
-            node1 = s.make_graph(graph)
+            node1 = child_graph(s, graph)
             add_edge(graph, node0, node1)
         return node0
 
-    def make_tables(self, table):
-        table[self.name] = self
-        self.symbol_table = ParamTable(table)
-        self.name.make_tables(table)
-        self.ret_type.make_tables(table)
-
-        self.params.make_tables(self.symbol_table)
-        self.statements.make_tables(SubTable(self.symbol_table))
-
-    @semafunc
-    def sema(self, data):
-        temp = data.ret_type
-        data.ret_type = self.ret_type
-        self.statements.sema(data)
-        data.ret_type = temp
-
     def make_tac(self, state):
-        out = [tac.StartFunc(self.name, self.symbol_table)]
-        with state.rename_table.scope():
-            out += self.params.make_tac(state)
-            state.decl_list = set()
-            temp = [tac.EndDecls()]
-            temp += self.statements.make_tac(state)
-            temp.append(tac.EndFunc(self.name))
-        return out + list(state.decl_list) + temp
+        # the temporaries go in a copy of the frame sema made, so the
+        # program may be lowered again
+        outer = state.frame
+        frame = state.frame = self.frame.copy()
+        try:
+            state.emit(tac.StartFunc(self.name, self.symbol_table, frame))
+            self.params.make_tac(state)
+            # the temporaries are only known once the body is lowered, so
+            # it goes to a buffer of its own until the decls are emitted
+            code, state.code = state.code, [tac.EndDecls()]
+            try:
+                self.statements.make_tac(state)
+                state.emit(tac.EndFunc(self.name))
+            finally:
+                body, state.code = state.code, code
+            # the params take the first slots, the locals and temporaries
+            # made above the rest
+            for slot in range(len(self.params), len(frame)):
+                state.emit(tac.Decl(frame.names[slot], frame.types[slot]))
+            code.extend(body)
+        finally:
+            state.frame = outer
         
 
 class If(AST):
+    __slots__    = ("cond", "success", "failure")
+    child_fields = ("cond", "success", "failure")
+
     def __init__(self, cond, success, failure):
         super(If, self).__init__()
         self.cond    = cond
@@ -210,37 +256,22 @@ class If(AST):
 
     def make_graph(self, graph):
         node0 = make_node("if", graph)
-        node1 = self.cond.make_graph(graph)
+        node1 = child_graph(self.cond, graph)
         add_edge(graph, node0, node1, "cond")
         node2 = make_node("success", graph)
         node3 = make_node("fail", graph)
         add_edge(graph, node0, node2)
         add_edge(graph, node0, node3)
         for s in self.success:
-            node1 = s.make_graph(graph)
+            node1 = child_graph(s, graph)
             add_edge(graph, node2, node1)
 
         if self.failure:
             for s in self.failure:
-                node1 = s.make_graph(graph)
+                node1 = child_graph(s, graph)
                 add_edge(graph, node3, node1)
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        self.cond.make_tables(table)
-        self.success.make_tables(SubTable(self.symbol_table))
-        if self.failure:
-            self.failure.make_tables(SubTable(self.symbol_table))
-
-    @semafunc
-    def sema(self, data):
-        type0 = self.cond.sema(data)
-        resolve_type(type0, Type("int"))
-        self.success.sema(data)
-        if self.failure:
-            self.failure.sema(data)
-
     def make_tac(self, state):
         """
             CMP
@@ -255,74 +286,53 @@ class If(AST):
                 FN
             L1:
         """
-        out = []
         l0 = state.make_label()
-        out += self.cond.make_tac(state)
-        out.append(tac.JZ(l0, state.last_var()))
-        with state.rename_table.scope():
-            out += self.success.make_tac(state)
+        self.cond.make_tac(state)
+        state.emit(tac.JZ(l0, state.last_var()))
+        self.success.make_tac(state)
 
         if self.failure:
             l1 = state.make_label()
-            out.append(tac.JP(l1))
+            state.emit(tac.JP(l1))
 
-        out.append(l0)
+        state.emit(l0)
 
         if self.failure:
-            with state.rename_table.scope():
-                out += self.failure.make_tac(state)
-            out.append(l1)
-        return out
+            self.failure.make_tac(state)
+            state.emit(l1)
 
 class Return(AST):
-    def __init__(self, statement):  
+    __slots__    = ("statement",)
+    child_fields = ("statement",)
+
+    def __init__(self, statement):
         super(Return, self).__init__()
         self.statement = statement
 
     def make_graph(self, graph):
         node0 = make_node("return", graph)
         if self.statement:
-            node1 = self.statement.make_graph(graph)
+            node1 = child_graph(self.statement, graph)
             add_edge(graph, node0, node1)
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        if self.statement:
-            self.statement.make_tables(table)
-
-    @semafunc
-    def sema(self, data):
-        if self.statement:
-            # Check if we are returning from a void function
-            if data.ret_type == ast.Type("void"):
-                msg = "Returning value from void function"
-                raise SemaReturnValueFromVoidError(msg)
-            # Check that the return type matched the data returned.
-            type0 = self.statement.sema(data)
-            try:
-                resolve_type(type0, data.ret_type)
-            except SemaTypeResolveError:
-                raise SemaIncorrectReturnTypeError("{} {}".format(type0, data.ret_type))
-        elif data.ret_type != ast.Type("void"):
-            #TODO: Improve the error message given.
-            msg = "No return value given"
-            raise SemaNoReturnValueError(msg)
-
     def make_tac(self, state):
         if self.statement:
-            out = self.statement.make_tac(state)
-            out.append(tac.Return(state.last_var()))
-            return out
-        return [tac.Return(None)]
+            self.statement.make_tac(state)
+            state.emit(tac.Return(state.last_var()))
+        else:
+            state.emit(tac.Return(None))
 
 def resolve_type(type0, type1, operation = None):
-    if not type0 == type1:
+    """ check two canonical types are the same type """
+    if type0 is not type1:
         raise SemaTypeResolveError("{} != {}".format(type0, type1))
     return type0
 
 class Binop(AST):
-    depth = 0
+    __slots__    = ("optype", "lhs", "rhs")
+    child_fields = ("lhs", "rhs")
+
     def __init__(self, optype, lhs, rhs):
         super(Binop, self).__init__()
         self.optype = optype
@@ -330,82 +340,82 @@ class Binop(AST):
         self.rhs    = rhs
 
     def __str__(self):
-        out =  self.optype
-        Binop.depth += 1
-        out += "\n" + Binop.depth * "\t" + str(self.lhs)
-        out += "\n" + Binop.depth * "\t" + str(self.rhs)
-        Binop.depth -= 1
+        return self._str(1)
+
+    def _str(self, depth):
+        """ return the node with its operands on lines of their own,
+            indented by depth tabs.
+        """
+        out = self.optype
+        for x in (self.lhs, self.rhs):
+            text = x._str(depth + 1) if isinstance(x, Binop) else str(x)
+            out += "\n" + depth * "\t" + text
         return out
 
     def make_graph(self, graph):
         node0 = make_node(self.optype, graph)
-        node1 = self.lhs.make_graph(graph)
-        node2 = self.rhs.make_graph(graph)
+        node1 = child_graph(self.lhs, graph)
+        node2 = child_graph(self.rhs, graph)
         add_edge(graph, node0, node1, "lhs")
         add_edge(graph, node0, node2, "rhs")
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        self.lhs.make_tables(table)
-        self.rhs.make_tables(table)
-        #Check if this should be a string
-        #self.optype.make_tables(table)
-
-    @semafunc
-    def sema(self, data):
-        type0 = self.lhs.sema(data)
-        type1 = self.rhs.sema(data)
-        return resolve_type(type0, type1, self.optype)
-
     def make_tac(self, state):
-        out = self.lhs.make_tac(state)
+        self.lhs.make_tac(state)
         t0 = state.last_var()
-        out += self.rhs.make_tac(state)
+        self.rhs.make_tac(state)
         t1 = state.last_var()
         t2 = state.make_temp()
-        out.append(tac.Op(self.optype, t2, t0, t1))
-        return out
+        state.emit(tac.Op(self.optype, t2, t0, t1))
+
+class Op(Binop):
+    __slots__ = ()
+
+class Comp(Binop):
+    __slots__ = ()
+
+class Assign(Binop):
+    __slots__ = ()
 
-class Op(Binop): pass
-class Comp(Binop): pass
-class Assign(Binop):    
     def make_tac(self, state):
-        out = []
         if self.optype == ":=":
-            out += self.rhs.make_tac(state)
+            self.rhs.make_tac(state)
             rhs_temp = state.last_var()
-            out += self.lhs.make_tac(state)
-            out.append(tac.Assign(state.last_var(), rhs_temp))
+            self.lhs.make_tac(state)
+            state.emit(tac.Assign(state.last_var(), rhs_temp))
         else:
             mapping = {"-=" : "-", "+=" : "+"}
             op = mapping[self.optype]
 
-            out += self.rhs.make_tac(state)
+            self.rhs.make_tac(state)
             t0 = state.last_var()
 
-            out += self.lhs.make_tac(state)
+            self.lhs.make_tac(state)
             t1 = state.last_var()
-            out.append(tac.Op(op,state.last_var(), t1, t0))
-            out += self.lhs.make_tac(state)
-        return out
+            state.emit(tac.Op(op,state.last_var(), t1, t0))
+            self.lhs.make_tac(state)
 
 class Import(AST):
+    __slots__   = ("identifier",)
+    name_fields = ("identifier",)
+
     def __init__(self, identifier):
+        super(Import, self).__init__()
         self.identifier = identifier
 
     def make_graph(self, graph):
         node0 = make_node("import", graph)
-        node1 = self.identifier.make_graph(graph)
+        node1 = child_graph(self.identifier, graph)
         add_edge(graph, node0, node1)
         return node0
 
-    @semafunc
-    def sema(self, data):
-        return None
-
 class FuncCall(AST):
+    __slots__    = ("identifier", "params")
+    child_fields = ("params",)
+    name_fields  = ("identifier",)
+
     def __init__(self, identifier, params):
+        super(FuncCall, self).__init__()
         self.identifier = identifier
         self.params     = params
 
@@ -414,45 +424,22 @@ class FuncCall(AST):
         node1 = make_node(self.identifier, graph)
         add_edge(graph, node0, node1, "name")
         for param in self.params:
-            node2 = param.make_graph(graph)
+            node2 = child_graph(param, graph)
             add_edge(graph, node0, node2, "param")
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        self.identifier.make_tables(table)
-        for s in self.params:
-            s.make_tables(table)
-
-    @semafunc
-    def sema(self, data):
-        try:
-            function = self.symbol_table[self.identifier]
-        except KeyError:
-            msg = "function {} cannot be found.".format(self.identifier.value),
-            raise SemaFunctionUndefinedError(msg)
-        if not isinstance(function, Function):
-            msg = "identifier {} is not a function".format(function)
-            raise SemaCallingNonFunctionError(msg)
-        if len(function.params) != len(self.params):
-            raise SemaParamMismatchError(
-                      "number of arguments to function does not match")
-        for type0, statement in zip(function.params, self.params):
-            type1 = statement.sema(data)
-            resolve_type(type0.type, type1)
-        return function.ret_type
-
     def make_tac(self, state):
-        out = [] 
         #TODO: Add function names to rename table
         name = self.identifier
         for p in self.params[::-1]:
-            out += p.make_tac(state)
-            out.append(tac.Param(state.last_var()))
-        out.append(tac.FuncCall(name, state.make_temp()))
-        return out
+            p.make_tac(state)
+            state.emit(tac.Param(state.last_var()))
+        state.emit(tac.FuncCall(name, state.make_temp()))
 
 class Type(AST):
+    __slots__   = ("identifier",)
+    name_fields = ("identifier",)
+
     def __init__(self, identifier):
         super(Type, self).__init__()
         if isinstance(identifier, str):
@@ -465,14 +452,9 @@ class Type(AST):
     def make_graph(self, graph):
         return self.identifier.make_graph(graph)
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        self.identifier.make_tables(table)
-
     def make_tac(self, state):
         #TODO: Add types to the rename table
         state.set_var(self)
-        return []
 
     def __str__(self):
         return str(self.identifier)
@@ -480,8 +462,18 @@ class Type(AST):
     def __eq__(self, other):
         return self.identifier == other.identifier
 
+    def __reduce_ex__(self, protocol):
+        # the builtin types stay the same objects when unpickled
+        if builtin_types.get(self.identifier.value) is self:
+            return builtin_type, (self.identifier.value,)
+        return super(Type, self).__reduce_ex__(protocol)
+
 class For(AST):
+    __slots__    = ("decl", "invariant", "post", "statements")
+    child_fields = ("decl", "invariant", "post", "statements")
+
     def __init__(self, decl, invariant, post, statements):
+        super(For, self).__init__()
         self.decl       = decl
         self.invariant  = invariant
         self.post       = post
@@ -490,42 +482,20 @@ class For(AST):
     def make_graph(self, graph):
         node0 = make_node("for", graph)
         if self.decl:
-            node1 = self.decl.make_graph(graph)
+            node1 = child_graph(self.decl, graph)
             add_edge(graph, node0, node1, "decl")
         if self.invariant:
-            node1 = self.invariant.make_graph(graph)
+            node1 = child_graph(self.invariant, graph)
             add_edge(graph, node0, node1, "invariant")
         if self.post:
-            node1 = self.post.make_graph(graph)
+            node1 = child_graph(self.post, graph)
             add_edge(graph, node0, node1, "post")
         for s in self.statements:
-            node1 = s.make_graph(graph)
+            node1 = child_graph(s, graph)
             add_edge(graph, node0, node1)
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = SubTable(table)
-        if self.decl:
-            self.decl.make_tables(self.symbol_table)
-        if self.invariant:
-            self.invariant.make_tables(self.symbol_table)
-        if self.post:
-            self.post.make_tables(self.symbol_table)
-        self.statements.make_tables(self.symbol_table)
-
-    @semafunc
-    def sema(self, data):
-        if self.decl:
-            type0 = self.decl.sema(data)
-        if self.invariant:
-            type0 = self.invariant.sema(data)
-            resolve_type(type0, Type("int"))
-        if self.post:
-            type0 = self.post.sema(data)
-        self.statements.sema(data)
-
     def make_tac(self, state):
-        out = []
         """
             INIT
             JP L1
@@ -540,47 +510,36 @@ class For(AST):
         """
         l0 = state.make_label()
         l1 = state.make_label()
-        out = []
-        with state.rename_table.scope():
-            if self.decl:
-                out += self.decl.make_tac(state)
-            out.append(tac.JP(l1))
-            out.append(l0)
-            with state.rename_table.scope():
-                out += self.statements.make_tac(state)
-            if self.post:
-                out += self.post.make_tac(state)
-            out.append(l1)
-            if self.invariant:
-                out += self.invariant.make_tac(state)
-            out.append(tac.JNZ(l0, state.last_var()))
-        return out
+        if self.decl:
+            self.decl.make_tac(state)
+        state.emit(tac.JP(l1))
+        state.emit(l0)
+        self.statements.make_tac(state)
+        if self.post:
+            self.post.make_tac(state)
+        state.emit(l1)
+        if self.invariant:
+            self.invariant.make_tac(state)
+        state.emit(tac.JNZ(l0, state.last_var()))
 
 class While(AST):
+    __slots__    = ("cond", "statements")
+    child_fields = ("cond", "statements")
+
     def __init__(self, cond, statements):
+        super(While, self).__init__()
         self.cond       = cond
         self.statements = statements
 
     def make_graph(self, graph):
         node0 = make_node("while", graph)
-        node1 = self.cond.make_graph(graph)
+        node1 = child_graph(self.cond, graph)
         add_edge(graph, node0, node1, "cond")
         for s in self.statements:
-            node2 = s.make_graph(graph)
+            node2 = child_graph(s, graph)
             add_edge(graph, node0, node2)
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        self.cond.make_tables(self.symbol_table)
-        self.statements.make_tables(SubTable(self.symbol_table))
-
-    @semafunc
-    def sema(self, data):
-        type0 = self.cond.sema(data)
-        resolve_type(type0, "int")
-        self.statements.sema(data)
-
     def make_tac(self, state):
         """
             JP L1
@@ -592,67 +551,51 @@ class While(AST):
                 CMP
                 JNZ L0
         """
-        out = []
         l0 = state.make_label()
         l1 = state.make_label()
-        out.append(tac.JP(l1))
-        out.append(l0)
-        with state.rename_table.scope():
-            out += self.statements.make_tac(state)
-        out.append(l1)
-        out += self.cond.make_tac(state)
-        out.append(tac.JNZ(l0, state.last_var()))
-        return out
+        state.emit(tac.JP(l1))
+        state.emit(l0)
+        self.statements.make_tac(state)
+        state.emit(l1)
+        self.cond.make_tac(state)
+        state.emit(tac.JNZ(l0, state.last_var()))
 
 class Decl(AST):
+    __slots__    = ("type", "var", "expr")
+    child_fields = ("expr",)
+    name_fields  = ("type", "var")
+
     def __init__(self, type, var, expr):
+        super(Decl, self).__init__()
         self.type = type
         self.var  = var
         self.expr = expr
 
     def make_graph(self, graph):
         node0 = make_node("decl", graph)
-        node1 = self.type.make_graph(graph)
-        node2 = self.var.make_graph(graph)
+        node1 = child_graph(self.type, graph)
+        node2 = child_graph(self.var, graph)
         add_edge(graph, node0, node1)
         add_edge(graph, node0, node2)
 
         if self.expr:
-            node3 = self.expr.make_graph(graph)
+            node3 = child_graph(self.expr, graph)
             add_edge(graph, node0, node3, "init")
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        self.var.make_tables(table)
-        if self.expr:
-            self.expr.make_tables(table)
-        try:
-            table[self.var] = self.type
-        except KeyError:
-            #TODO: Add a better error message
-            msg = ""
-            raise SemaMultipleDeclarationError(msg)
-
-    @semafunc
-    def sema(self, data):
-        if self.expr:
-            type0 = self.expr.sema(data)
-            resolve_type(self.type, type0)
-
     def make_tac(self, state):
-        state.rename_table.add(self.var)
-        name = state.rename_table[self.var]
-        self.type.make_tac(state)
-        state.decl_list.add(tac.Decl(name, state.last_var()))
+        frame, slot = self.var.slot
+        name = frame.names[slot]
         if self.expr:
-            out = self.expr.make_tac(state)
-            out.append(tac.Assign(name, state.last_var()))
-            return out
-        return []
+            self.expr.make_tac(state)
+            state.emit(tac.Assign(name, state.last_var()))
 
 class ParamList(AST):
+    __slots__    = ("data",)
+    child_fields = ("data",)
+
     def __init__(self, *data):
+        super(ParamList, self).__init__()
         self.data = list(data)
 
     def append(self, data):
@@ -664,26 +607,25 @@ class ParamList(AST):
     def __setitem__(self, key, value):
         self.data[key] = value
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        for i in self.data:
-            i.make_tables(self.symbol_table)
-
     def __len__(self):
         return len(self.data)
 
     def make_tac(self, state):
-        out = []
         for s in self:
-            out += s.type.make_tac(state)
-            out.append(tac.Argument(s.type, s.var))
-            out += s.make_tac(state)
-        return out
+            s.type.make_tac(state)
+            state.emit(tac.Argument(s.type, s.var))
 
 class Identifier(AST):
+    """ binding is what the identifier names, set by passes.ResolvePass
+        along with slot, the (frame, slot) of the variable it names.
+    """
+    __slots__ = ("value", "binding", "slot")
+
     def __init__(self, value):
         super(Identifier, self).__init__()
-        self.value = value
+        self.value   = value
+        self.binding = None
+        self.slot    = None
 
     def __repr__(self):
         return "Identifier<{}>".format(self.value)
@@ -695,9 +637,6 @@ class Identifier(AST):
         node0 = make_node(str(self), graph)
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table 
-
     def suffix(self, string):
         """ Add a suffix to a single length identifier
         """
@@ -718,21 +657,23 @@ class Identifier(AST):
     def __hash__(self):
         return self.value.__hash__()
 
-    @semafunc
-    def sema(self, data):
-        try:
-            return self.symbol_table[self]
-        except KeyError:
-            msg = "Identifier '{}' cannot be found in the current scope.".format(self.value)
-            raise SemaIdentifierUndefinedError(msg)
+    def __reduce__(self):
+        # made from its value before the rest is loaded, the symbol tables
+        # reached through binding hash it while they are unpickled
+        state = dict((name, getattr(self, name))
+                     for name in AST.__slots__ + Identifier.__slots__[1:])
+        return Identifier, (self.value,), (None, state)
 
     def make_tac(self, state):
-        var = state.rename_table[self]
-        state.set_var(var)
-        return []
+        frame, slot = self.slot
+        state.set_var(frame.names[slot])
 
 class FieldAccess(AST):
+    __slots__   = ("identifiers",)
+    name_fields = ("identifiers",)
+
     def __init__(self, *identifiers):
+        super(FieldAccess, self).__init__()
         self.identifiers = identifiers
 
     def __repr__(self):
@@ -748,24 +689,27 @@ class FieldAccess(AST):
             return 0
         return 1
 
-    def make_tables(self, table):
-        self.symbol_table = table 
-
 class Field(AST):
+    __slots__   = ("type", "name")
+    name_fields = ("type", "name")
+
     def __init__(self, type, name):
+        super(Field, self).__init__()
         self.type = type
         self.name = name
 
 class Struct(AST):
+    __slots__   = ("name", "fields")
+    name_fields = ("name", "fields")
+
     def __init__(self, name, *fields):
+        super(Struct, self).__init__()
         self.name   = name
         self.fields = fields
 
-    def make_tables(self, table):
-        self.symbol_table = table
-        table[self.name] = self
-
 class Literal(AST):
+    __slots__ = ("value",)
+
     def __init__(self, value):
         super(Literal, self).__init__()
         self.value = value
@@ -777,47 +721,38 @@ class Literal(AST):
         node0 = make_node(self.value, graph)
         return node0
 
-    def make_tables(self, table):
-        self.symbol_table = table
-
-    def sema(self, data):
-        pass
-
     def make_tac(self, state):
         state.set_var(self)
-        return []
 
 class String(Literal):
-    count = 0
+    __slots__ = ()
+
     def __init__(self, value):
         super(String, self).__init__(value)
-        self.count = String.count
-        String.count += 1
+
     def __str__(self):
         return '"{}"'.format(self.value)
 
-    @semafunc
-    def sema(self, data):
-        return Type("string")
-
 class Number(Literal):
+    __slots__ = ()
+
     def __init__(self, value):
         super(Number, self).__init__(value)
 
 class Integer(Number):
+    __slots__ = ()
+
     def __init__(self, value):
         super(Integer, self).__init__(value)
 
-    @semafunc
-    def sema(self, data):
-        return Type("int")
-
 class Float(Number):
+    __slots__ = ()
+
     def __init__(self, value):
         super(Float, self).__init__(value)
 
-    @semafunc
-    def sema(self, data):
-        #TODO: Change to correct type.
-        return Type("int")
+# the canonical builtin types, shared by every TypeRegistry
+builtin_types = dict((name, Type(name)) for name in ("int", "string", "void"))
 
+def builtin_type(name):
+    return builtin_types[name]
@@ -1,5 +1,7 @@
 #!/usr/bin/env python2.7
 import os
+from array import array
+from itertools import izip
 from parse import *
 import syntax_tree as ast
 from graph import Graph
@@ -29,57 +31,22 @@ class Label(object):
     def __str__(self):
         return ".L{}:".format(self.value)
 
-class RenameTable(object):
-    """ RenameTable is used to keep track of identifiers that should
-        be renamed, if they are in the table they are renames else
-        they are left alone, adding an element to the table will
-        add a suffix to make it unique. this suffix stacks so that
-        if multiple nested  "scopes"  are dealt with correctly.
-
-        e.g a -> a'
-    """
-    def __init__(self):
-        self.data = [{}]
-
-    def scope(self):
-        class ContextManager(object):
-            def __enter__(s):
-                self.push()
-            def __exit__(s, *args, **kwargs):
-                self.pop()
-        return ContextManager()
-
-    def push(self):
-        self.data.append({})
-
-    def pop(self):
-        self.data.pop()
-
-    def add(self, value):
-        if value in self.data[-1]:
-            raise Exception("Duplicate Key : {}".format(value))
-        try:
-            prev = self[value]
-            self.data[-1][value] = prev.suffix("'")
-        except KeyError:
-            self.data[-1][value] = value
-
-    def __getitem__(self, key):
-        for d in self.data[::-1]:
-            try:
-                if key in d:
-                    return d[key]
-            except KeyError:
-                pass
-        raise KeyError()
-
 class TacState(object):
-    def __init__(self):
+    """ TacState is what the make_tac() methods of the tree share while
+        lowering it, they emit each instruction once to code, a list
+        unless another is given, such as a TacArray.
+    """
+    def __init__(self, code = None):
         self.label_count = 0
         self._last_var    = None
         self.temp_count  = 0
-        self.rename_table = RenameTable()
-        self.decl_list = set()
+        # the passes.Frame of the function being lowered, a copy of the
+        # one sema made that its temporaries are added to
+        self.frame       = None
+        self.code        = [] if code is None else code
+
+    def emit(self, x):
+        self.code.append(x)
 
     def last_var(self):
         assert self._last_var
@@ -92,9 +59,8 @@ class TacState(object):
         out = self.temp_count
         self.temp_count += 1
         id0 = ast.Identifier("_t{}".format(self.temp_count))
-        self._last_var = id0
-        #TODO: Cleanup the handling of this.
-        self.decl_list.add(Decl(id0 , ast.Type("int")))
+        frame, slot = self.frame.add(id0, ast.builtin_type("int"))
+        self._last_var = frame.names[slot]
         return self._last_var
 
     def make_label(self):
@@ -133,9 +99,10 @@ class Param(TAC):
         return "param {}".format(self.value)
 
 class StartFunc(TAC):
-    def __init__(self, identifier, symbol_table):
+    def __init__(self, identifier, symbol_table, frame):
         self.identifier = identifier
         self.symbol_table = symbol_table
+        self.frame = frame
 
     def __str__(self):
         return "startfunc {}".format(self.identifier)
@@ -229,16 +196,133 @@ class EndDecls(TAC):
     def __str__(self):
         return "end_decls"
 
-def make_tac(input):
+# the instructions a TacArray holds, each with the arguments it is made
+# from, which are kept in its dest, src1 and src2 columns in that order
+instruction_fields = (
+    (Argument,  ("type", "identifier")),
+    (FuncCall,  ("identifier", "retval")),
+    (Param,     ("value",)),
+    (StartFunc, ("identifier", "symbol_table", "frame")),
+    (EndFunc,   ("identifier",)),
+    (Assign,    ("identifier", "var")),
+    (Return,    ("value",)),
+    (JP,        ("label",)),
+    (JNZ,       ("label", "var")),
+    (JZ,        ("label", "var")),
+    (Load,      ("dest", "source")),
+    (Store,     ("dest", "source")),
+    (Decl,      ("name", "typename")),
+    (EndDecls,  ()),
+)
+opcodes = dict((cls, index) for index, (cls, fields) in enumerate(instruction_fields))
+# a Label is kept as itself, an Op as an opcode for each operator
+label_opcode = len(instruction_fields)
+op_opcode    = label_opcode + 1
+operators    = ("+", "-", "*", "/", "<", ">", "<=", ">=", "==", "!=")
+op_fields    = ("assign", "lhs", "rhs")
+
+class TacArray(object):
+    """ TacArray holds TAC compactly, each instruction is an opcode and up
+        to three operands kept in parallel array("i") columns in place of
+        an object of its own. An operand is the index in values of the
+        name, constant or label it is, each is kept once, or -1 for None.
+
+        Iterating over it makes the instructions as objects one at a time,
+        from_tac() and to_tac() convert a whole list.
+    """
+    def __init__(self):
+        self.opcode  = array("i")
+        self.dest    = array("i")
+        self.src1    = array("i")
+        self.src2    = array("i")
+        self.values  = []
+        self._index  = {}
+
+    @classmethod
+    def from_tac(cls, instructions):
+        out = cls()
+        out.extend(instructions)
+        return out
+
+    def to_tac(self):
+        return list(self)
+
+    def operand(self, value):
+        """ return the index of value in values, adding it if needed """
+        if value is None:
+            return -1
+        try:
+            return self._index[id(value)]
+        except KeyError:
+            index = self._index[id(value)] = len(self.values)
+            self.values.append(value)
+            return index
+
+    def append(self, x):
+        if isinstance(x, Label):
+            opcode, args = label_opcode, (x,)
+        elif isinstance(x, Op):
+            opcode = op_opcode + operators.index(x.op)
+            args   = [getattr(x, name) for name in op_fields]
+        else:
+            opcode = opcodes[x.__class__]
+            args   = [getattr(x, name) for name in instruction_fields[opcode][1]]
+        args = [self.operand(v) for v in args] + [-1] * (3 - len(args))
+        self.opcode.append(opcode)
+        self.dest.append(args[0])
+        self.src1.append(args[1])
+        self.src2.append(args[2])
+
+    def extend(self, instructions):
+        for x in instructions:
+            self.append(x)
+
+    def __len__(self):
+        return len(self.opcode)
+
+    def __iter__(self):
+        values = self.values
+        get    = lambda index: values[index] if index >= 0 else None
+        for opcode, dest, src1, src2 in izip(self.opcode, self.dest, self.src1, self.src2):
+            if opcode == label_opcode:
+                yield values[dest]
+            elif opcode >= op_opcode:
+                yield Op(operators[opcode - op_opcode], get(dest), get(src1), get(src2))
+            else:
+                cls, fields = instruction_fields[opcode]
+                yield cls(*[get(x) for x in (dest, src1, src2)[:len(fields)]])
+
+    def __getstate__(self):
+        return ([x.tostring() for x in (self.opcode, self.dest, self.src1, self.src2)],
+                self.values)
+
+    def __setstate__(self, state):
+        columns, self.values = state
+        self.opcode, self.dest, self.src1, self.src2 = [array("i", x) for x in columns]
+        self._index = dict((id(v), i) for i, v in enumerate(self.values))
+
+def make_tac(input, cache = None):
+    """ compile input to TAC. If cache is a CompileCache the TAC is taken
+        from it when there, and stored in it when not.
+    """
+    # parse imports this module through syntax_tree, so it may not have
+    # been finished when this module was
+    from parse import parse
+    if cache is not None:
+        entry = cache.load(input)
+        if entry is not None:
+            return entry[1].to_tac()
     try:
         prog = parse(input)
-        prog.make_tables()
         prog.sema()
-        return prog.make_tac(TacState())
+        out = prog.make_tac(TacState())
     except ast.SemaError as e:
         raise
     except KeyError as e:
         raise
+    if cache is not None:
+        cache.store(input, prog, TacArray.from_tac(out))
+    return out
 
 if __name__ == "__main__":
     test = """
@@ -267,15 +351,15 @@ if __name__ == "__main__":
     }
     """
     prog = parse(test)
+    prog.sema()
     tac = prog.make_tac(TacState())
-    graph = Graph()
-    last = None
-    for x in tac:
-        print(x)
-        graph.add_node(str(x))
-        if len(graph.nodes) > 1:
-            graph.add_edge(-2, -1)
-    graph.output("tac_output.png")
+    with Graph("tac_output.dot") as graph:
+        for x in tac:
+            print(x)
+            graph.add_node(str(x))
+            if graph.count > 1:
+                graph.add_edge(-2, -1)
+    graph.render("tac_output.png")
 
     """
     argument_parser = argparse.ArgumentParser()
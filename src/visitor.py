@@ -0,0 +1,105 @@
+#!/usr/bin/env python2.7
+
+class Pass(object):
+    """ Pass is one analysis over the syntax tree, run by a PassManager.
+
+        enter() is called on a node before its children and leave() after
+        them. Each calls the method named enter_<class> or leave_<class>
+        for the class of the node or the nearest of its bases that has
+        one, or default_enter() and default_leave() if none do.
+    """
+    def __init__(self):
+        self._handlers = {}
+
+    def handler(self, prefix, cls):
+        key = (prefix, cls)
+        try:
+            return self._handlers[key]
+        except KeyError:
+            pass
+        for base in cls.__mro__:
+            method = getattr(self, prefix + base.__name__, None)
+            if method is not None:
+                break
+        else:
+            method = getattr(self, "default_" + prefix[:-1])
+        self._handlers[key] = method
+        return method
+
+    def enter(self, node):
+        return self.handler("enter_", type(node))(node)
+
+    def leave(self, node):
+        return self.handler("leave_", type(node))(node)
+
+    def default_enter(self, node):
+        pass
+
+    def default_leave(self, node):
+        pass
+
+    def finish(self, node):
+        """ called once the whole tree has been walked """
+        pass
+
+class PassManager(object):
+    """ PassManager runs any number of passes over a tree in a single
+        walk, calling every pass in turn on each node.
+
+        The walk is made from an explicit stack, so deep trees do not use
+        up Python frames. An exception raised by a pass is given the node
+        it was raised on as its ast attribute, unless it already has one.
+    """
+    def __init__(self, *passes):
+        self.passes    = passes
+        self._handlers = {}
+
+    def handlers(self, cls):
+        """ return the enter and leave handlers of every pass for nodes of
+            class cls, leaving out those that do nothing.
+        """
+        try:
+            return self._handlers[cls]
+        except KeyError:
+            pass
+        enters = [p.handler("enter_", cls) for p in self.passes]
+        leaves = [p.handler("leave_", cls) for p in self.passes]
+        result = ([x for x in enters if x.__func__ is not _default_enter],
+                  [x for x in leaves if x.__func__ is not _default_leave],
+                  cls.child_fields)
+        self._handlers[cls] = result
+        return result
+
+    def run(self, root):
+        handlers = self.handlers
+        stack    = [root]
+        while stack:
+            node = stack.pop()
+            try:
+                if type(node) is tuple:
+                    leaves, node = node
+                    for leave in leaves:
+                        leave(node)
+                    continue
+                enters, leaves, fields = handlers(type(node))
+                for enter in enters:
+                    enter(node)
+            except Exception as e:
+                if not hasattr(e, "ast"):
+                    e.ast = node
+                raise
+            stack.append((leaves, node))
+            for name in reversed(fields):
+                value = getattr(node, name)
+                if value is None:
+                    continue
+                if isinstance(value, (list, tuple)):
+                    stack.extend(reversed(value))
+                else:
+                    stack.append(value)
+        for p in self.passes:
+            p.finish(root)
+        return root
+
+_default_enter = Pass.default_enter.__func__
+_default_leave = Pass.default_leave.__func__
@@ -0,0 +1,14 @@
+// The functions of stdlib.asm that every program may call. Only the
+// declarations are read, see src/interface.py, the bodies are left empty.
+
+// print the integer value and a newline
+function print(int value)
+{}
+
+// print the string value
+function prints(string value)
+{}
+
+// print the character value
+function putc(int value)
+{}
@@ -1,12 +1,24 @@
 #!/usr/bin/env python2.7
+import os
+import re
+import shutil
+import tempfile
 import unittest
 import types
+from StringIO import StringIO
 from ddt import ddt, data
+from multiprocessing.pool import ThreadPool
 
 from src             import lexer
+from src.cache       import *
+from src.graph       import *
 from src.parse       import *
+from src.passes      import *
 from src.syntax_tree import *
 from src.tac         import *
+from src.visitor     import *
+from src.compile     import Compiler
+from src.interface   import compile_interface, load_interface
 
 @ddt
 class TestLexer(unittest.TestCase):
@@ -77,11 +89,98 @@ class TestLexer(unittest.TestCase):
         string_list = ['"Hello, world!"']
         self._test_type(string_list, lexer.String)
 
+    def test_line_pos(self):
+        data = "a := 1 // note\n  b\n\n\"x\" c"
+        toks = [(type(x), x.get_line(), x.get_pos()) for x in lexer.tokenise(data)]
+        self.assertEqual(toks, [(lexer.Identifier, 0, 0),
+                                (lexer.Assign,     0, 2),
+                                (lexer.Integer,    0, 5),
+                                (lexer.Identifier, 1, 2),
+                                (lexer.Newline,    1, 3),
+                                (lexer.String,     3, 0),
+                                (lexer.Identifier, 3, 4)])
+
+    def test_token_stream(self):
+        data = 'function f(int a) -> int\n{\n    return a * 2 // x\n    "s"\n}'
+        stream = lexer.tokenise_stream(data)
+        expected = [x for x in lexer.tokenise(data)]
+        self.assertEqual(len(stream), len(expected))
+        for x, y in zip(stream, expected):
+            self.assertIs(type(x), type(y))
+            self.assertEqual((x.value, x.line, x.pos, x.kind),
+                             (y.value, y.line, y.pos, y.kind))
+
+    def test_kind_mask(self):
+        toks = [x for x in lexer.tokenise("while ( <= a")]
+        mask = lexer.kind_mask(lexer.Comp, "(")
+        self.assertEqual([bool(mask >> x.kind & 1) for x in toks],
+                         [False, True, True, False])
+        self.assertTrue(lexer.kind_mask("while") >> toks[0].kind & 1)
+        self.assertFalse(lexer.kind_mask("for") >> toks[0].kind & 1)
+        self.assertTrue(lexer.kind_mask(lexer.Keyword) >> toks[0].kind & 1)
+        with self.assertRaises(ValueError):
+            lexer.kind_mask("name")
+
+    @data(1, 2, 3, 5, 64)
+    def test_tokenise_file(self, chunk_size):
+        data = 'a := 12.5 + 1e10 // c "\n\n\nb := "multi\nline" <= 0x1f\n'
+        expected = [(type(x), x.value, x.line, x.pos) for x in lexer.tokenise(data)]
+        toks = [(type(x), x.value, x.line, x.pos)
+                for x in lexer.tokenise_file(StringIO(data), chunk_size)]
+        self.assertEqual(toks, expected)
+
+    @data((10, 0, "x"), (10, 1, ""), (2, 0, "\n\n"), (22, 0, "// c"),
+          (0, 0, "1."), (27, 5, '"s\n"'), (40, 0, "\n"))
+    def test_token_stream_edit(self, edit):
+        data = "a := 12 + b\nreturn 1e // d\nwhile(x < 10) {}\n"
+        offset, removed, inserted = edit
+        stream = lexer.tokenise_stream(data)
+        stream.edit(offset, removed, inserted)
+        expected = lexer.tokenise_stream(
+            data[:offset] + inserted + data[offset + removed:])
+        self.assertEqual(stream.source.text, expected.source.text)
+        for name in ("kinds", "starts", "lengths", "lines", "cols"):
+            self.assertEqual(getattr(stream, name), getattr(expected, name))
+
+    def test_split_points(self):
+        data = 'a "\n\n" b\n\nc // "\n\nd "x\ny"\ne'
+        points = lexer.split_points(data, 8)
+        self.assertEqual(points, [10, 18, 26])
+
+    def test_tokenise_parallel(self):
+        data = 'function f()\n{\n    prints("a\n\nb") // "\n    x := 1.5\n}\n' * 20
+        expected = lexer.tokenise_stream(data)
+        stream = lexer.tokenise_parallel(data, processes = 3, threshold = 0)
+        for name in ("kinds", "starts", "lengths", "lines", "cols"):
+            self.assertEqual(getattr(stream, name), getattr(expected, name))
+
+    def test_lexing_error(self):
+        with self.assertRaises(Exception):
+            [x for x in lexer.tokenise("a $ b")]
+
     @unittest.expectedFailure
     def test_escaped_string(self):
         string_list = ['"escaped string\""']
         self._test_type(string_list, lexer.String)
 
+class TestSourceFile(unittest.TestCase):
+    def setUp(self):
+        self.source = SourceFile("ab\ncd\n\nefg\n")
+
+    def test_location(self):
+        self.assertEqual(self.source.location(0), (0, 0))
+        self.assertEqual(self.source.location(4), (1, 1))
+        self.assertEqual(self.source.location(6), (2, 0))
+        self.assertEqual(self.source.location(9), (3, 2))
+
+    def test_lines(self):
+        self.assertEqual(self.source.line(1), "cd")
+        self.assertEqual(self.source.lines(2, 10), ["", "efg", ""])
+
+    def test_highlight(self):
+        tok = [x for x in lexer.tokenise(self.source)][-2]
+        self.assertEqual(tok.highlight(1, 1), "\nefg\n^~~\n\n")
+
 @ddt
 class TestParser(unittest.TestCase):
     def assertIsFunction(self, data):
@@ -140,6 +239,20 @@ class TestParser(unittest.TestCase):
                 "a < 10"]
         self._test_generic(data, parse_expression , ast.Binop)
 
+    def test_expression_assoc(self):
+        tree = parse_expression(Parser("a := b += c - d - e"))
+        self.assertIsInstance(tree.rhs, ast.Assign)
+        self.assertEqual(tree.rhs.optype, "+=")
+        self.assertIsInstance(tree.rhs.rhs.lhs, ast.Op)
+        self.assertEqual(tree.rhs.rhs.rhs.value, "e")
+
+    def test_long_expression(self):
+        terms = 5 * sys.getrecursionlimit()
+        for op in ["+", ":="]:
+            p = Parser(" {} ".format(op).join(["a"] * terms))
+            parse_expression(p)
+            self.assertTrue(p.done())
+
     def test_for(self):
         data = ["for(int i := 0; i < 10; i += 1){}",
                 "for(int i := 0; i < 10;){}",
@@ -180,6 +293,86 @@ class TestParser(unittest.TestCase):
         data = ["a()", "a(1)", "a(1, 2, 3)"]
         self._test_generic(data, parse_func_call, ast.FuncCall)
 
+    def test_token_window(self):
+        data = """\
+        function a(int x) -> int
+        {
+            int y := x * (x + 1)
+            return y
+        }
+        """
+        tree = parse(lexer.tokenise_file(StringIO(data), 8), window = 16)
+        self.assertIsFunction(tree.statements[0])
+        window = lexer.TokenWindow(lexer.tokenise(data), 4)
+        window[10]
+        with self.assertRaises(lexer.TokenWindowError):
+            window[2]
+
+    def test_packrat(self):
+        data = "x := " + "f(" * 6 + "1 2" + ")" * 6
+        plain   = Parser(data)
+        packrat = Parser(data, packrat = True)
+        self.assertEqual(str(parse_statement(plain)),
+                         str(parse_statement(packrat)))
+        self.assertEqual(plain.pos, packrat.pos)
+        self.assertTrue(packrat.memo)
+        self.assertFalse(plain.instrumented)
+        self.assertTrue(packrat.instrumented)
+        self.assertTrue(Parser(data, hook = ParseHook()).instrumented)
+
+    def test_deep_nesting(self):
+        depth = 3 * sys.getrecursionlimit()
+        data  = "while(a){\nif(b){\n" * depth + "x := 1\n" + "}\n}\n" * depth
+        p     = Parser(data.rstrip())
+        tree  = parse_statement(p)
+        self.assertTrue(p.done())
+        for i in range(depth):
+            self.assertIsInstance(tree, ast.While)
+            tree = tree.statements.statements[0].success.statements[0]
+        self.assertIsInstance(tree, ast.Assign)
+
+    def test_profiler(self):
+        profiler = ParseProfiler()
+        parse_statement(Parser("a := f(1 2)", hook = profiler))
+        self.assertEqual(profiler.calls["parse_statement"], 1)
+        self.assertEqual(profiler.backtracks["parse_func_call"], 1)
+        self.assertEqual(profiler.calls["parse_identifier"], 3)
+        self.assertFalse(profiler.stack)
+        self.assertIn("parse_expression", profiler.report())
+
+    def test_trace(self):
+        out = StringIO()
+        parse_identifier(Parser("a", hook = TraceHook(out)))
+        self.assertEqual(out.getvalue(), "enter: parse_identifier\n"
+                                         "OK   : parse_identifier\n")
+        # without one it writes to sys.stdout as it is at the time
+        saved, sys.stdout = sys.stdout, StringIO()
+        try:
+            parse_identifier(Parser("a", hook = TraceHook()))
+            out, sys.stdout = sys.stdout, saved
+        finally:
+            sys.stdout = saved
+        self.assertEqual(out.getvalue(), "enter: parse_identifier\n"
+                                         "OK   : parse_identifier\n")
+
+    def test_packrat_commit(self):
+        data = "function a(int x)\n{\n    f(x)\n}\nfunction b()\n{\n}\n"
+        parser = Parser(data, packrat = True)
+        parse_program(parser)
+        self.assertTrue(all(pos >= parser.pos for _, pos in parser.memo))
+
+    @data(("a(1)",   "atomic_table",    ["parse_func_call", "parse_identifier"]),
+          ("a.b",    "atomic_table",    ["parse_field_access", "parse_identifier"]),
+          ("(1)",    "atomic_table",    ["parse_paren_expr"]),
+          ("int a",  "statement_table", ["parse_decl", "parse_expression"]),
+          ("a := 1", "statement_table", ["parse_expression"]),
+          ("while",  "statement_table", ["parse_while"]),
+          ("}",      "statement_table", []))
+    def test_predict(self, data):
+        source, table, expected = data
+        rules = predict(Parser(source), globals()[table])
+        self.assertEqual([x.__name__ for x in rules], expected)
+
     def test_if(self):
         data = ["if(a < 10){}"]
         self._test_generic(data, parse_if, ast.If)
@@ -196,6 +389,80 @@ class TestParser(unittest.TestCase):
         data = ["", "function a(){}"]
         self._test_generic(data, parse_program, ast.Program)
 
+    def test_declaration_starts(self):
+        data = "import a\nfunction f()\n{\nfunction g()\n{\n}\n}\nstruct s\n{\n}\n"
+        tokens = lexer.tokenise_stream(data)
+        self.assertEqual([tokens[x].value for x in declaration_starts(tokens)],
+                         ["import", "function", "struct"])
+        self.assertEqual(declaration_starts(tokens)[1], 3)
+
+    def test_parse_program_parallel(self):
+        data = "import a\n" + "function f(int x) -> int\n{\n    return x\n}\n" * 20
+        expected = parse_program(Parser(data))
+        program  = parse_program_parallel(data, processes = 3, threshold = 0)
+        self.assertEqual(len(program.statements), len(expected.statements))
+        for a, b in zip(program.statements, expected.statements):
+            self.assertEqual(type(a), type(b))
+            self.assertEqual((a.start, a.end), (b.start, b.end))
+        self.assertIsNotNone(program.source)
+        with self.assertRaises(ParseError):
+            parse_program_parallel(data + "function g(\n", processes = 3, threshold = 0)
+
+    def test_reparse_program(self):
+        data = "".join("function {}(int x) -> int\n{{\n    return x\n}}\n".format(name)
+                       for name in "fgh")
+        previous = parse_program(Parser(data))
+        previous.sema()
+        first, second, third = previous.statements
+        spans  = [(x.start, x.end) for x in (first, first.name, first.params[0].var,
+                                             first.statements.statements[0])]
+        offset = data.index("return", data.index("function", 1))
+        edit   = (offset, 0, "x += 1\n    ")
+        text   = data[:offset] + edit[2] + data[offset:]
+        program = reparse_program(text, previous, [edit])
+        self.assertIs(program.statements[0], first)
+        self.assertEqual([(x.start, x.end) for x in (first, first.name, first.params[0].var,
+                                                     first.statements.statements[0])], spans)
+        self.assertIsNot(program.statements[1], second)
+        self.assertIs(program.statements[2], third)
+        self.assertEqual(len(program.statements[1].statements.statements), 2)
+        self.assertEqual(third.end, text.rindex("}") + 1)
+        self.assertEqual(program.source.location(third.start), (9, 0))
+
+    def test_reparse_program_regroup(self):
+        data = "function h()\n{\n}\nfunction f()\n{\n}\nfunction g()\n{\n}\n"
+        previous = parse_program(Parser(data))
+        previous.sema()
+        h = previous.statements[0]
+        spans = [(x.start, x.end) for x in (h, h.name)]
+        # move the end of f down so that g is inside it
+        end   = data.index("}", data.index("function f"))
+        edits = [(end, 2, ""), (len(data) - 2, 0, "}\n")]
+        text  = "function h()\n{\n}\nfunction f()\n{\nfunction g()\n{\n}\n}\n"
+        program = reparse_program(text, previous, edits)
+        self.assertEqual(len(program.statements), 2)
+        self.assertIsFunction(program.statements[1].statements.statements[0])
+        self.assertEqual([(x.start, x.end) for x in (h, h.name)], spans)
+
+    def test_reparse_checked_program(self):
+        data = ("function f(int x) -> int\n{\n    return x\n}\n"
+                "function h(int x) -> int\n{\n    return x\n}\n"
+                "function g(int x) -> int\n{\n    return f(x)\n}\n")
+        previous = parse_program(Parser(data))
+        previous.sema()
+        f, h, g = previous.statements
+        spans  = [(x.start, x.end) for x in (f, f.name, f.params[0].var)]
+        offset = data.index("return", data.index("function h"))
+        edit   = (offset, 0, "x := 1\n    ")
+        text   = data[:offset] + edit[2] + data[offset:]
+        program = reparse_program(text, previous, [edit])
+        self.assertIs(program.statements[2], g)
+        # g binds f and its params bind their decls, neither is followed
+        self.assertEqual([(x.start, x.end) for x in (f, f.name, f.params[0].var)], spans)
+        self.assertEqual(g.start, text.index("function g"))
+        self.assertEqual(g.params[0].var.start, text.index("x)", g.start))
+        program.sema()
+
     @unittest.expectedFailure
     def test_import(self):
         data = ["import io.network"]
@@ -231,10 +498,58 @@ class TestParserFail(unittest.TestCase):
         data = ["for(){",]
         self._test_fail(parse_for, data)
 
+    def test_expression(self):
+        data = ["a +", "+ a b", "a b +", "a := := b"]
+        self._test_fail(parse_expression, data)
+
     def _test_identifier(self):
         data = ["a."]
         self._test_fail(parse_identifier, data)
 
+class TestParserRecovery(unittest.TestCase):
+    data = """
+function a(int x) -> int
+{
+    int y := x +
+    if(y < ) {
+        y := 2
+    }
+    return y
+}
+function b(
+{
+}
+function c()
+{
+    while(1) {
+        z := )
+    }
+    z := 3 )
+}
+"""
+    def test_errors(self):
+        errors  = []
+        program = parse_program(Parser(self.data, errors = errors))
+        self.assertEqual([(e[1].line, e[1].value) for e in errors],
+                         [(3, "int"), (4, "("), (9, "\n"), (15, "z"), (17, ")")])
+        self.assertEqual([str(x.name) for x in program.statements], ["a", "c"])
+        self.assertEqual(len(program.statements[0].statements.statements), 1)
+        self.assertEqual(len(program.statements[1].statements.statements), 2)
+        self.assertEqual(errors[4].highlight(), "    z := 3 )\n           ^\n")
+
+    def test_no_errors(self):
+        data   = "function a()\n{\n    x := 1\n}\n"
+        errors = []
+        program = parse_program(Parser(data, errors = errors))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(program.statements), 1)
+
+    def test_stray_tokens(self):
+        errors  = []
+        program = parse_program(Parser("} x\nfunction a()\n{\n}\n", errors = errors))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(program.statements), 1)
+
 class TestTAC(unittest.TestCase):
     def test_two_funcs_same_param_name(self):
         data = """\
@@ -244,8 +559,190 @@ class TestTAC(unittest.TestCase):
         {}
         """
         tree = parse(data)
+        tree.sema()
         tree.make_tac(TacState())
 
+    def test_tac_array(self):
+        data = """\
+        function f(int a) -> int
+        {
+            while(a < 10)
+            {
+                a += 1
+            }
+            prints("a")
+            return f(a * 2)
+        }
+        """
+        tree = parse(data)
+        tree.sema()
+        code  = tree.make_tac(TacState())
+        array = TacArray.from_tac(code)
+        self.assertEqual(len(array), len(code))
+        self.assertEqual([str(x) for x in array.to_tac()], [str(x) for x in code])
+        labels = [x for x in array if isinstance(x, Label)]
+        jumps  = [x.label for x in array if isinstance(x, (JP, JNZ))]
+        self.assertEqual(sorted(map(id, labels)), sorted(map(id, jumps)))
+
+    def test_emit(self):
+        data = """\
+        function f(int a) -> int
+        {
+            if(a)
+            {
+                int b := a + 1
+                return b
+            }
+            return f(a - 1)
+        }
+        """
+        tree = parse(data)
+        tree.sema()
+        state = TacState()
+        code  = tree.make_tac(state)
+        self.assertIs(code, state.code)
+        # the decls come before the body they were found lowering
+        kinds = [x.__class__.__name__ for x in code]
+        self.assertEqual((kinds[0], kinds[-1]), ("StartFunc", "EndFunc"))
+        self.assertLess(max(i for i, k in enumerate(kinds) if k == "Decl"),
+                        kinds.index("EndDecls"))
+        # lowering leaves the checked tree as it was, so it may be repeated
+        frame = tree.statements[0].frame
+        self.assertEqual(len(frame), 2)
+        array = tree.make_tac(TacState(TacArray()))
+        self.assertEqual(len(frame), 2)
+        self.assertEqual(len(array), len(code))
+        self.assertEqual([str(x) for x in array], [str(x) for x in code])
+
+class TestCompileCache(unittest.TestCase):
+    data = """\
+    function f(int a) -> int
+    {
+        int x := a + 1
+        prints("s")
+        return f(x)
+    }
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache     = CompileCache(self.directory, version = "test")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.assertIsNone(self.cache.load(self.data))
+        expected = [str(x) for x in make_tac(self.data, self.cache)]
+        program, code = self.cache.load(self.data)
+        self.assertEqual([str(x) for x in code], expected)
+        self.assertEqual([str(x) for x in make_tac(self.data, self.cache)], expected)
+        self.assertIs(program.symbol_table[Identifier("f")], program.statements[0])
+
+    def test_source(self):
+        source = SourceFile(self.data)
+        make_tac(source, self.cache)
+        program, code = self.cache.load(SourceFile(self.data))
+        self.assertEqual(program.source.text, self.data)
+
+    def test_miss(self):
+        make_tac(self.data, self.cache)
+        self.assertIsNone(self.cache.load(self.data + "\n"))
+        self.assertIsNone(CompileCache(self.directory, version = "other").load(self.data))
+
+class TestInterface(unittest.TestCase):
+    data = "// f\nfunction f(int a) -> int\n{}\n"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache     = CompileCache(self.directory, version = "test")
+        self.path      = os.path.join(self.directory, "f.x")
+        with open(self.path, "w") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compile(self):
+        function = compile_interface(self.data)[Identifier("f")]
+        self.assertIsInstance(function, Function)
+        self.assertEqual(str(function.ret_type), "int")
+
+    def test_snapshot(self):
+        table    = load_interface(self.path, self.cache)
+        snapshot = self.cache.read(self.cache.key("interface\n" + self.data))
+        self.assertIsInstance(snapshot[Identifier("f")], Function)
+        self.assertIs(load_interface(self.path, self.cache), table)
+
+    def test_no_cache(self):
+        home  = os.path.join(self.directory, "home")
+        names = ("HOME", "PYCOMPILER_CACHE")
+        saved = dict((name, os.environ.get(name)) for name in names)
+        os.mkdir(home)
+        os.environ["HOME"] = home
+        os.environ.pop("PYCOMPILER_CACHE", None)
+        try:
+            table = load_interface(self.path)
+            Compiler().compile("function main() -> int\n{\n    prints(\"a\")\n}\n")
+        finally:
+            for name in names:
+                if saved[name] is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = saved[name]
+        self.assertIsInstance(table[Identifier("f")], Function)
+        self.assertEqual(os.listdir(home), [])
+
+    def test_path_memo(self):
+        table = load_interface(self.path)
+        self.assertIs(load_interface(self.path), table)
+        with open(self.path, "w") as f:
+            f.write(self.data + "function g()\n{}\n")
+        changed = load_interface(self.path)
+        self.assertIsNot(changed, table)
+        self.assertIsInstance(changed[Identifier("g")], Function)
+
+    def test_shared_signatures(self):
+        table = compile_interface(self.data)
+        tree  = parse("function main() -> int\n{\n    return f(1)\n}\n")
+        tree.sema(builtins = table)
+        f = table[Identifier("f")]
+        # sema leaves the nodes of the interface, which every program shares
+        self.assertIsNone(f.params[0].type.expr_type)
+        self.assertIsNone(f.ret_type.expr_type)
+        self.assertIs(tree.statements[0].statements.statements[0].statement.expr_type,
+                      builtin_type("int"))
+
+    def test_stdlib(self):
+        table = builtin_table(self.cache)
+        for name in ("print", "prints", "putc"):
+            self.assertEqual(len(table[Identifier(name)].params), 1)
+
+class TestCompiler(unittest.TestCase):
+    data = """\
+    function main() -> int
+    {
+        prints("a")
+        prints("b")
+        return {}
+    }
+    """
+
+    def test_compile(self):
+        asm = Compiler().compile(self.data.replace("{}", "0"))
+        self.assertIn("main:", asm)
+        self.assertIn('strconst_1:\ndb "b", 0', asm)
+
+    def test_threads(self):
+        compiler = Compiler()
+        sources  = [self.data.replace("{}", str(i)) for i in range(8)]
+        expected = [compiler.compile(x) for x in sources]
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual(pool.map(compiler.compile, sources * 4), expected * 4)
+        finally:
+            pool.close()
+
 @ddt
 class TestAST(unittest.TestCase):
     @data((ast.FieldAccess("a", "b"),      ast.FieldAccess("a", "b")),
@@ -262,6 +759,97 @@ class TestAST(unittest.TestCase):
         for lhs, rhs in data:
             self.assertNotEquals(lhs, rhs)
 
+    def test_slots(self):
+        node = ast.Binop("+", ast.Integer(1), ast.Integer(2))
+        self.assertFalse(hasattr(node, "__dict__"))
+        with self.assertRaises(AttributeError):
+            node.value = 3
+        self.assertEqual((node.start, node.end), (-1, -1))
+
+    def test_binop_str(self):
+        node = parse_statement(Parser("x := a + (b * c)\n"))
+        expected = ":=\n\tx\n\t+\n\t\ta\n\t\t*\n\t\t\tb\n\t\t\tc"
+        self.assertEqual(str(node), expected)
+        # the depth is not kept between calls, so threads may share nodes
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual(pool.map(str, [node] * 64), [expected] * 64)
+        finally:
+            pool.close()
+
+    def test_positions(self):
+        data = "x := a + (b * c)\n"
+        node = parse_statement(Parser(data))
+        self.assertEqual((node.start, node.end), (0, len(data) - 1))
+        self.assertEqual(data[node.rhs.start:node.rhs.end], "a + (b * c)")
+        self.assertEqual(data[node.rhs.rhs.start:node.rhs.rhs.end], "(b * c)")
+        self.assertEqual(node.rhs.highlight(SourceFile(data)),
+                         "x := a + (b * c)\n     ^~~~~~~~~~~\n")
+
+class TestGraph(unittest.TestCase):
+    def test_dot_writer(self):
+        out = StringIO()
+        with DotWriter(out) as graph:
+            graph.add_node('say "hi"\n')
+            graph.add_node("b", None)
+            graph.add_edge(-2, -1, "e")
+            graph.add_edge(1, 0)
+        self.assertEqual(out.getvalue(), 'digraph {\n'
+                                         '0 [label="say \\"hi\\"\\n", shape=box];\n'
+                                         '1 [label="b"];\n'
+                                         '0 -> 1 [label="e"];\n'
+                                         '1 -> 0;\n'
+                                         '}\n')
+
+    def test_max_depth(self):
+        tree = parse_expression(Parser("1 + 2 * 3"))
+        out  = StringIO()
+        with DotWriter(out, max_depth = 1) as graph:
+            tree.make_graph(graph)
+        labels = re.findall(r'label="([^"]*)"', out.getvalue())
+        self.assertEqual(labels, ["+", "1", "*", "...", "...",
+                                  "lhs", "rhs", "lhs", "rhs"])
+        self.assertNotIn("shape", out.getvalue())
+
+class TestPassManager(unittest.TestCase):
+    class Recorder(Pass):
+        def __init__(self, name, out):
+            super(TestPassManager.Recorder, self).__init__()
+            self.name = name
+            self.out  = out
+
+        def enter_Binop(self, node):
+            self.out.append((self.name, "enter", node.optype))
+
+        def leave_Binop(self, node):
+            self.out.append((self.name, "leave", node.optype))
+
+        def leave_Literal(self, node):
+            self.out.append((self.name, "leave", node.value))
+
+    class Failing(Pass):
+        def leave_Literal(self, node):
+            if node.value == "2":
+                raise ValueError(node.value)
+
+    def test_single_walk(self):
+        out  = []
+        tree = parse_expression(Parser("1 + 2 * 3"))
+        PassManager(self.Recorder("a", out), self.Recorder("b", out)).run(tree)
+        self.assertEqual(out, [("a", "enter", "+"), ("b", "enter", "+"),
+                               ("a", "leave", "1"), ("b", "leave", "1"),
+                               ("a", "enter", "*"), ("b", "enter", "*"),
+                               ("a", "leave", "2"), ("b", "leave", "2"),
+                               ("a", "leave", "3"), ("b", "leave", "3"),
+                               ("a", "leave", "*"), ("b", "leave", "*"),
+                               ("a", "leave", "+"), ("b", "leave", "+")])
+
+    def test_error_node(self):
+        tree = parse_expression(Parser("1 + 2 * 3"))
+        with self.assertRaises(ValueError) as context:
+            PassManager(self.Failing()).run(tree)
+        self.assertIs(context.exception.ast, tree.rhs.lhs)
+
 class TestSymbolTable(unittest.TestCase):
     def test_identifier_in_same_scope(self):
         table = SymbolTable()
@@ -292,37 +880,97 @@ class TestSymbolTable(unittest.TestCase):
         with self.assertRaises(KeyError):
             table[ast.Identifier("a")]
 
-    def test_symbol_table_children(self):
+    def test_symbol_table_siblings(self):
         table0 = SymbolTable()
         table1 = SymbolTable(table0)
+        table1[ast.Identifier("a")] = Type("int")
+        # opening a sibling closes table1 and all it declared
         table2 = SymbolTable(table0)
-
-        self.assertIs(table0.children[0], table1)
-        self.assertIs(table0.children[1], table2)
-
-class TestRenameTable(unittest.TestCase):
-    def setUp(self):
-        self.table = RenameTable()
+        self.assertIs(table1.parent, table0)
+        self.assertIs(table2.parent, table0)
+        self.assertIsNone(table2.lookup(ast.Identifier("a")))
+        with self.assertRaises(SymbolTableClosedError):
+            table1.lookup(ast.Identifier("a"))
+        with self.assertRaises(SymbolTableClosedError):
+            table1[ast.Identifier("b")] = Type("int")
+        self.assertNotIn(ast.Identifier("b"), table0.scopes.names)
+
+    def test_closed_after_sema(self):
+        tree = parse("function f(int a) -> int\n{\n    return a\n}\n")
+        tree.sema()
+        with self.assertRaises(SymbolTableClosedError):
+            tree.statements[0].symbol_table.lookup(ast.Identifier("a"))
+
+class TestResolvePass(unittest.TestCase):
+    data = """\
+    function f(int a) -> int
+    {
+        int b := a
+        if(1)
+        {
+            int a := b
+            if(1)
+            {
+                int a := a
+                return a
+            }
+        }
+        return a
+    }
+    """
 
     def test_no_rename(self):
-        self.table.add(Identifier("a"))
-        self.table.push()
-        self.table.add(Identifier("b"))
-        self.assertEqual(self.table[Identifier("b")], Identifier("b"))
+        tree = parse(self.data)
+        tree.sema()
+        f = tree.statements[0]
+        self.assertEqual([str(x) for x in f.frame.names[:2]], ["a", "b"])
 
     def test_with_rename(self):
-        self.table.add(Identifier("a"))
-        self.table.push()
-        self.table.add(Identifier("a"))
-        self.assertEqual(self.table[Identifier("a")], Identifier("a'"))
-
-    def test_two_levels(self):
-        self.table.add(Identifier("a"))
-        self.table.push()
-        self.table.add(Identifier("a"))
-        self.table.push()
-        self.table.add(Identifier("a"))
-        self.assertEqual(self.table[Identifier("a")], Identifier("a''"))
+        tree = parse(self.data)
+        tree.sema()
+        f = tree.statements[0]
+        self.assertEqual([str(x) for x in f.frame.names], ["a", "b", "a'2", "a'3"])
+
+    def test_sibling_scopes(self):
+        data = """\
+        function f(int a) -> int
+        {
+            if(a)
+            {
+                int i := 1
+                a += i
+            }
+            else
+            {
+                int i := 2
+                a -= i
+            }
+            return a
+        }
+        """
+        tree = parse(data)
+        tree.sema()
+        f = tree.statements[0]
+        names = [str(x) for x in f.frame.names]
+        self.assertEqual(names[:3], ["a", "i", "i'2"])
+        self.assertEqual(len(set(names)), len(names))
+        state = TacState()
+        code  = [str(x) for x in tree.make_tac(state)]
+        self.assertIsNone(state.frame)
+        self.assertEqual(code.count("decl i int"), 1)
+        self.assertEqual(code.count("decl i'2 int"), 1)
+
+    def test_bindings(self):
+        tree = parse(self.data)
+        tree.sema()
+        f     = tree.statements[0]
+        outer = f.statements.statements
+        inner = outer[1].success.statements[1].success.statements
+        # the innermost a is initialised from the a it hides
+        self.assertIs(inner[0].expr.binding, outer[1].success.statements[0])
+        self.assertEqual(inner[0].expr.slot, (f.frame, 2))
+        self.assertEqual(inner[1].statement.slot, (f.frame, 3))
+        self.assertIs(outer[2].statement.binding, f.params[0])
 
 class TestSema(unittest.TestCase):
     def test_function_call(self):
@@ -356,6 +1004,47 @@ class TestSema(unittest.TestCase):
         tree = parse(data)
         tree.sema()
 
+    def test_call_before_declaration(self):
+        data = """\
+        function main()
+        {
+            print(test_0(10))
+        }
+
+        function test_0(int a) -> int
+        {
+            return a
+        }
+        """
+        tree = parse(data)
+        tree.sema()
+        self.assertIs(tree.symbol_table[Identifier("test_0")], tree.statements[1])
+
+    def test_canonical_types(self):
+        data = """\
+        struct pair
+        {
+            int first
+            int second
+        }
+
+        function f(int a) -> int
+        {
+            pair p
+            p.first := a + 1
+            return p.second
+        }
+        """
+        tree = parse(data)
+        tree.sema()
+        f = tree.statements[1]
+        assign = f.statements.statements[1]
+        self.assertIs(assign.expr_type, builtin_types["int"])
+        self.assertIs(assign.lhs.expr_type, assign.rhs.expr_type)
+        self.assertIs(f.statements.statements[0].type.expr_type,
+                      tree.types.intern("pair"))
+        self.assertIs(tree.statements[0].expr_type, tree.types.intern("pair"))
+
     def test_for_loop(self):
         data = """\
         function test_0()
@@ -415,6 +1104,21 @@ class TestSemaErrors(unittest.TestCase):
         """
         self.assertRaisesSemaError(data, SemaFunctionUndefinedError)
 
+    def test_undefined_field(self):
+        data = """\
+        struct pair
+        {
+            int first
+        }
+
+        function main()
+        {
+            pair p
+            p.second := 1
+        }
+        """
+        self.assertRaisesSemaError(data, SemaIdentifierUndefinedError)
+
     def test_missing_function_parameter(self):
         data = """\
         function func_0(int a)